@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Offline benchmark of the blockcheck tests.
+
+Starts local stand-ins for everything the tests talk to on 127.0.0.0/8:
+DNS servers (the ISP one, Google DNS and the fake one), Google DNS API,
+isup service, HTTP proxy and the sites themselves behind a "DPI middlebox"
+which blocks them the way an ISP does. Then runs test_dns(),
+test_http_access(), test_https_cert() and test_dpi() under every scenario,
+checks their verdicts and compares their run time with the limits.
+Then checks that DNS queries get answers when some nameservers fail.
+
+    python3 benchmark.py [--scenario NAME] [--repeat N] [--factor F] [--json]
+
+Exit code is 1 if any test gave an unexpected verdict or was too slow.
+Requires openssl to create the certificates of the sites.
+"""
+import argparse
+import base64
+import http.server
+import json
+import os
+import os.path
+import re
+import socket
+import socketserver
+import ssl
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import dns.flags
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+import blockcheck
+
+SYSTEM_DNS = '127.0.0.1'
+GOOGLE_DNS = '127.0.0.2'
+FAKE_DNS = '127.0.0.3'
+SERVICES = '127.0.0.4'  # Google DNS API, isup and the proxy
+THIRD_PARTY_DNS = '127.0.0.5'  # Another public DNS server
+STUB_IP = '127.0.3.1'  # Where the ISP DNS sends blocked names
+DOT_NAME = 'dns.bench'  # Name in the certificate of Google DNS over TLS
+TRUNCATED_NAME = 'truncated.bench'  # THIRD_PARTY_DNS replies to it with the TC flag, others a bit later
+
+DELAY = 0.5  # Seconds the middlebox holds requests to blocked sites in 'delay' scenario
+PACKET_SIZE = 1500  # The middlebox inspects only this many first bytes of a request
+IO_TIMEOUT = 30  # Seconds the servers wait for clients
+
+# Names checked by test_dns(), all blocked
+DNS_NAMES = {'blocked-a.bench': '127.0.1.101', 'blocked-b.bench': '127.0.1.102',
+             'blocked-c.bench': '127.0.1.103', 'blocked-d.bench': '127.0.1.104'}
+
+# Sites of the simulated network: (role, IP, scheme, lookfor). Blocked ones
+# are blocked by the middlebox in the scenarios which have an action.
+SITES = [
+    ('http_open', '127.0.1.1', 'http', 'novostey', False),
+    ('http_blocked', '127.0.1.2', 'http', 'PoniBooru', True),
+    ('http_subdomain', '127.0.1.3', 'http', 'Antizapret', True),
+    ('https_a', '127.0.2.1', 'https', 'rutracker', True),
+    ('https_b', '127.0.2.2', 'https', 'lolibooru', True),
+    ('dpi_a', '127.0.4.1', 'http', 'groupcp.php"', True),
+    ('dpi_b', '127.0.4.2', 'http', 'Related Posts', True),
+]
+DPI_HOSTS = {'dpi_a': 'rutracker.bench', 'dpi_b': 'pbooru.bench'}
+
+SCENARIOS = {
+    # Parameters:
+    #    dns:      what DNS does: None, 'spoof' (the ISP resolver returns STUB_IP
+    #              for blocked names), 'block' (public DNS servers do not reply)
+    #              'cdn' (the ISP resolver returns other addresses of the
+    #              same network, like a CDN does) or 'stall' (Google DNS over
+    #              HTTPS and TLS accept connections but never reply)
+    #    action:   what the middlebox does with blocked sites: None, 'stub' (a stub
+    #              page, forged certificate for HTTPS), 'reset', 'delay' or 'drop'
+    #    expected: acceptable results of every test, verdict or the number of
+    #              working DPI bypass techniques
+    #    limits:   seconds every test may take
+
+    'clean':
+        {'dns': None, 'action': None,
+         'expected': {'dns': (0,), 'http': (blockcheck.HTTP_ACCESS_NOBLOCKS,), 'https': (0,), 'dpi': (15,)},
+         'limits': {'dns': 4, 'http': 1, 'https': 1, 'dpi': 1}},
+
+    'cdn':
+        {'dns': 'cdn', 'action': None,
+         'expected': {'dns': (0,), 'http': (blockcheck.HTTP_ACCESS_NOBLOCKS,), 'https': (0,), 'dpi': (15,)},
+         'limits': {'dns': 4, 'http': 1, 'https': 1, 'dpi': 1}},
+
+    'stub':
+        {'dns': 'spoof', 'action': 'stub',
+         'expected': {'dns': (3,), 'http': (blockcheck.HTTP_ACCESS_IPDPI,), 'https': (1,), 'dpi': (11, 12)},
+         'limits': {'dns': 4, 'http': 1, 'https': 1, 'dpi': 1}},
+
+    'reset':
+        {'dns': 'block', 'action': 'reset',
+         'expected': {'dns': (4,), 'http': (blockcheck.HTTP_ACCESS_IPDPI,), 'https': (2,), 'dpi': (11, 12)},
+         'limits': {'dns': 4, 'http': 1, 'https': 1, 'dpi': 1}},
+
+    'delay':
+        {'dns': None, 'action': 'delay',
+         'expected': {'dns': (0,), 'http': (blockcheck.HTTP_ACCESS_NOBLOCKS,), 'https': (0,), 'dpi': (15,)},
+         'limits': {'dns': 4, 'http': 2, 'https': 3, 'dpi': 4}},
+
+    'stall':
+        {'dns': 'stall', 'action': None,
+         'expected': {'dns': (0,), 'http': (blockcheck.HTTP_ACCESS_NOBLOCKS,), 'https': (0,), 'dpi': (15,)},
+         'limits': {'dns': 4, 'http': 1, 'https': 1, 'dpi': 1}},
+
+    'drop':
+        {'dns': None, 'action': 'drop',
+         'expected': {'dns': (0,), 'http': (blockcheck.HTTP_ACCESS_IPDPI,), 'https': (2,), 'dpi': (11, 12)},
+         # Dropped HTTP responses are waited for the whole probe_timeouts['http']
+         'limits': {'dns': 4, 'http': 17, 'https': 10, 'dpi': 17}},
+}
+
+STAGES = ('dns', 'http', 'https', 'dpi')
+DPI_HOST_RE = re.compile(rb'\r\nHost: ([^\r\n]*)\r\n')
+
+
+def _reset(conn):
+    """Close `conn` with RST."""
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    conn.close()
+
+
+def _hold(conn):
+    """Keep `conn` open without replying until the client gives up."""
+    try:
+        while conn.recv(65536):
+            pass
+    except OSError:
+        pass
+
+
+def _recv_exactly(conn, size):
+    """Read `size` bytes from `conn`, raise EOFError if it is closed before."""
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def _read_head(conn, data=b''):
+    """Read the request head from `conn`, `data` is what was already read."""
+    while b'\r\n\r\n' not in data and b'\n\n' not in data:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _page(body, status='200 OK'):
+    body = body.encode('utf-8')
+    return ("HTTP/1.1 {}\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: {}\r\n"
+            "Connection: close\r\n\r\n".format(status, len(body))).encode() + body
+
+
+def _origin_page(site):
+    return _page("<html><body>Origin of {}: {}</body></html>".format(site['role'], site['lookfor']))
+
+
+STUB_PAGE = _page("<html><body><h1>Доступ ограничен</h1></body></html>")
+
+
+class Simulator():
+    """All the local servers and the current scenario they follow."""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.scenario = SCENARIOS['clean']
+        self.servers = []
+        self.sites = {}
+        self.blocked_hosts = set()
+        self._make_certificates()
+
+    def _openssl(self, *args):
+        subprocess.run(('openssl',) + args, cwd=self.workdir, check=True, capture_output=True)
+
+    def _make_certificates(self):
+        """Create a CA with the origin certificate and a self-signed certificate a DPI forges."""
+        ips = ','.join('IP:' + ip for role, ip, scheme, lookfor, blocked in SITES if scheme == 'https')
+        with open(os.path.join(self.workdir, 'ext'), 'w') as ext:
+            ext.write('subjectAltName={},DNS:{}'.format(ips, DOT_NAME))
+        self._openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=Benchmark CA',
+                      '-keyout', 'ca.key', '-out', 'ca.pem')
+        self._openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=origin',
+                      '-keyout', 'origin.key', '-out', 'origin.csr')
+        self._openssl('x509', '-req', '-in', 'origin.csr', '-CA', 'ca.pem', '-CAkey', 'ca.key', '-CAcreateserial',
+                      '-days', '1', '-extfile', 'ext', '-out', 'origin.pem')
+        self._openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=ISP',
+                      '-addext', 'subjectAltName=' + ips, '-keyout', 'forged.key', '-out', 'forged.pem')
+        self.origin_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.origin_context.load_cert_chain(os.path.join(self.workdir, 'origin.pem'),
+                                            os.path.join(self.workdir, 'origin.key'))
+        self.forged_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.forged_context.load_cert_chain(os.path.join(self.workdir, 'forged.pem'),
+                                            os.path.join(self.workdir, 'forged.key'))
+
+    def _serve(self, server_class, address, handler):
+        server = server_class(address, handler)
+        server.simulator = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server
+
+    def start(self):
+        # All DNS servers share the port, as blockcheck uses one for all of them
+        system_dns = self._serve(_UDPServer, (SYSTEM_DNS, 0), DnsHandler)
+        dns_port = system_dns.server_address[1]
+        self._serve(_UDPServer, (GOOGLE_DNS, dns_port), DnsHandler)
+        self._serve(_UDPServer, (THIRD_PARTY_DNS, dns_port), DnsHandler)
+        self._serve(_TCPServer, (SYSTEM_DNS, dns_port), DnsStreamHandler)
+        self._serve(_TCPServer, (GOOGLE_DNS, dns_port), DnsStreamHandler)
+        dot = self._serve(_TCPServer, (GOOGLE_DNS, 0), DnsStreamHandler)
+        fake_dns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Never replies
+        fake_dns.bind((FAKE_DNS, dns_port))
+        self.fake_dns = fake_dns
+
+        services = self._serve(_HTTPServer, (SERVICES, 0), ServicesHandler)
+        proxy = self._serve(_TCPServer, (SERVICES, 0), ProxyHandler)
+        for role, ip, scheme, lookfor, blocked in SITES:
+            server = self._serve(_TCPServer, (ip, 0), MiddleboxHandler)
+            site = {'role': role, 'ip': ip, 'scheme': scheme, 'lookfor': lookfor, 'blocked': blocked,
+                    'port': server.server_address[1]}
+            site['host'] = DPI_HOSTS.get(role, '{}:{}'.format(ip, site['port']))
+            site['url'] = '{}://{}:{}/'.format(scheme, ip, site['port'])
+            server.site = self.sites[role] = site
+            if blocked:
+                self.blocked_hosts.add(site['host'])
+        self.configure(dns_port, dot.server_address[1], services.server_address[1], proxy.server_address[1])
+
+    def configure(self, dns_port, dot_port, services_port, proxy_port):
+        """Point blockcheck to the simulated network."""
+        services = '{}:{}'.format(SERVICES, services_port)
+        sites = self.sites
+        blockcheck.dns_port = dns_port
+        blockcheck.google_dns_tls = (DOT_NAME, dot_port)
+        blockcheck.google_doh = 'http://{}/dns-query'.format(services)
+        blockcheck.google_dns = GOOGLE_DNS
+        blockcheck.fake_dns = FAKE_DNS
+        blockcheck.third_party_dns = (THIRD_PARTY_DNS,)
+        blockcheck.dns_records_list = tuple(DNS_NAMES)
+        blockcheck.google_dns_api = 'http://{}/resolve'.format(services)
+        blockcheck.isup_server = services
+        blockcheck.isup_fmt = 'http://' + services + '/check.php?domain={}'
+        blockcheck.disable_isup = False
+        blockcheck.proxy_addr = '{}:{}'.format(SERVICES, proxy_port)
+        blockcheck.rtt_probe_addr = (SERVICES, services_port)
+        blockcheck.http_list = {
+            sites['http_open']['url']: {'status': 200, 'lookfor': sites['http_open']['lookfor']},
+            sites['http_blocked']['url']: {'status': 200, 'lookfor': sites['http_blocked']['lookfor']},
+            sites['http_subdomain']['url']: {'status': 200, 'lookfor': sites['http_subdomain']['lookfor'],
+                                             'subdomain': True, 'is_blacklisted': False},
+        }
+        blockcheck.https_list = {sites['https_a']['url'], sites['https_b']['url']}
+        blockcheck.dpi_list = {
+            site['host']: {'host': site['host'], 'urn': '/', 'lookfor': site['lookfor'], 'ip': site['ip'],
+                           'port': site['port']}
+            for role, site in sites.items() if role in DPI_HOSTS
+        }
+        # Trust the simulated CA, SSL contexts are created on first use
+        os.environ['SSL_CERT_FILE'] = os.path.join(self.workdir, 'ca.pem')
+        blockcheck.http_client.contexts.clear()
+
+    def resolve(self, name):
+        """Return the real address of `name`, also accepts IP addresses with port."""
+        if name in DNS_NAMES:
+            return DNS_NAMES[name]
+        for site in self.sites.values():
+            if name in (site['host'], site['ip'], '{}:{}'.format(site['ip'], site['port'])):
+                return site['ip']
+        return None
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.fake_dns.close()
+
+
+class _UDPServer(socketserver.ThreadingUDPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def _dns_reply(simulator, server, wire):
+    """
+    Return the reply of `server` (SYSTEM_DNS, GOOGLE_DNS, THIRD_PARTY_DNS
+    or None for encrypted DNS) to the query `wire`, None if it should not reply.
+    """
+    query = dns.message.from_wire(wire)
+    question = query.question[0]
+    name = question.name.to_text(omit_final_dot=True)
+
+    if server in (GOOGLE_DNS, THIRD_PARTY_DNS) and simulator.scenario['dns'] == 'block':
+        return None
+    response = dns.message.make_response(query)
+    address = simulator.resolve(name)
+    if address and server == SYSTEM_DNS and simulator.scenario['dns'] == 'spoof':
+        address = STUB_IP
+    if address and server == SYSTEM_DNS and simulator.scenario['dns'] == 'cdn':
+        address = address.rpartition('.')[0] + '.' + str(int(address.rpartition('.')[2]) ^ 128)
+    if address and question.rdtype == dns.rdatatype.A:
+        response.answer.append(dns.rrset.from_text(question.name, 300, 'IN', 'A', address))
+    elif not address:
+        response.set_rcode(dns.rcode.NXDOMAIN)
+    return response.to_wire()
+
+
+class DnsHandler(socketserver.BaseRequestHandler):
+    """DNS server of the ISP or Google, depending on the address it listens on."""
+
+    def handle(self):
+        data, sock = self.request
+        server = self.server.server_address[0]
+        reply = _dns_reply(self.server.simulator, server, data)
+        if reply and dns.message.from_wire(data).question[0].name.to_text(True) == TRUNCATED_NAME:
+            if server == THIRD_PARTY_DNS:
+                reply = dns.message.from_wire(reply)
+                reply.flags |= dns.flags.TC
+                reply = reply.to_wire()
+            else:
+                time.sleep(0.1)
+        if reply:
+            sock.sendto(reply, self.client_address)
+
+
+class DnsStreamHandler(socketserver.BaseRequestHandler):
+    """
+    DNS server over TCP, like DnsHandler, or Google DNS over TLS if it does
+    not listen on the DNS port. Answers queries as they come.
+    """
+
+    def handle(self):
+        simulator = self.server.simulator
+        conn = self.request
+        conn.settimeout(IO_TIMEOUT)
+        server_ip, port = self.server.server_address
+        try:
+            if port != blockcheck.dns_port:
+                if simulator.scenario['dns'] == 'stall':
+                    return _hold(conn)
+                conn = simulator.origin_context.wrap_socket(conn, server_side=True)
+                server_ip = None
+            while True:
+                wire = _recv_exactly(conn, struct.unpack('!H', _recv_exactly(conn, 2))[0])
+                reply = _dns_reply(simulator, server_ip, wire)
+                if reply is None:
+                    return _reset(conn)
+                conn.sendall(struct.pack('!H', len(reply)) + reply)
+        except (OSError, EOFError):
+            pass
+        finally:
+            # The TLS socket took over the connection from self.request
+            conn.close()
+
+
+class ServicesHandler(http.server.BaseHTTPRequestHandler):
+    """Google DNS API, Google DNS over HTTPS and isup service."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/resolve':
+            address = self.server.simulator.resolve(query.get('name', ''))
+            if address and query.get('type') in ('A', '1'):
+                reply = {'Status': 0, 'Answer': [{'name': query['name'], 'type': 1, 'TTL': 300, 'data': address}]}
+            else:
+                reply = {'Status': 0 if address else 3, 'Authority': [{'type': 6, 'TTL': 300}]}
+            body = json.dumps(reply).encode()
+        elif url.path == '/dns-query':
+            if self.server.simulator.scenario['dns'] == 'stall':
+                return _hold(self.connection)
+            wire = base64.urlsafe_b64decode(query['dns'] + '=' * (-len(query['dns']) % 4))
+            body = _dns_reply(self.server.simulator, None, wire)
+        elif url.path == '/check.php':
+            body = b'<div class="upicon">It is up</div>'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ProxyHandler(socketserver.BaseRequestHandler):
+    """HTTP proxy outside of the ISP network, it opens every site."""
+
+    def handle(self):
+        conn = self.request
+        conn.settimeout(IO_TIMEOUT)
+        try:
+            head = _read_head(conn)
+            url = head.split(b' ')[1].decode()
+            netloc = urllib.parse.urlsplit(url).netloc
+            site = next((site for site in self.server.simulator.sites.values()
+                         if netloc in (site['host'], '{}:{}'.format(site['ip'], site['port']))), None)
+            conn.sendall(_origin_page(site) if site else _page("Not found", '404 Not Found'))
+        except (OSError, IndexError, UnicodeDecodeError):
+            pass
+
+
+class MiddleboxHandler(socketserver.BaseRequestHandler):
+    """
+    A site behind the DPI of the ISP. The DPI only looks for the exact
+    "Host: <blocked host>" line in the first PACKET_SIZE bytes of a request,
+    HTTPS sites are blocked by IP address.
+    """
+
+    def handle(self):
+        simulator = self.server.simulator
+        site = self.server.site
+        action = simulator.scenario['action'] if site['blocked'] else None
+        conn = self.request
+        conn.settimeout(IO_TIMEOUT)
+        try:
+            if site['scheme'] == 'https':
+                if action == 'reset':
+                    return _reset(conn)
+                if action == 'drop':
+                    return _hold(conn)
+                if action == 'delay':
+                    time.sleep(DELAY)
+                context = simulator.forged_context if action == 'stub' else simulator.origin_context
+                with context.wrap_socket(conn, server_side=True) as tls:
+                    _read_head(tls)
+                    return tls.sendall(_origin_page(site))
+
+            first = conn.recv(PACKET_SIZE)
+            match = DPI_HOST_RE.search(first)
+            if action and match and match.group(1).decode('latin-1') in simulator.blocked_hosts:
+                if action == 'stub':
+                    return conn.sendall(STUB_PAGE)
+                if action == 'reset':
+                    return _reset(conn)
+                if action == 'drop':
+                    return _hold(conn)
+                if action == 'delay':
+                    time.sleep(DELAY)
+            _read_head(conn, first)
+            conn.sendall(_origin_page(site))
+        except (OSError, ssl.SSLError):
+            pass
+
+
+def run_test(stage, by_ip=False):
+    """Run the test of `stage` in a new run and return its result, duration and the run."""
+    run = blockcheck.RunContext(name=stage, resolver=[SYSTEM_DNS], quiet=True)
+    with blockcheck.use_run(run):
+        run.rtt = blockcheck.measure_rtt()
+        # Every test starts from scratch
+        blockcheck.google_api_cache.clear()
+        blockcheck.http_client.close()
+        started = time.perf_counter()
+        if stage == 'dns':
+            result = blockcheck.test_dns(blockcheck.DNS_IPV4)
+        elif stage == 'http':
+            result = blockcheck.test_http_access(by_ip)[0]
+        elif stage == 'https':
+            result = blockcheck.test_https_cert()
+        else:
+            result = len(blockcheck.test_dpi())
+        duration = time.perf_counter() - started
+    return result, duration, run
+
+
+def run_scenario(simulator, name, repeat=1, factor=1.0, verbose=False):
+    """Run all tests under scenario `name` and return a list of result dicts."""
+    scenario = simulator.scenario = SCENARIOS[name]
+    rows = []
+    by_ip = False
+    for stage in STAGES:
+        durations = []
+        for attempt in range(repeat):
+            result, duration, run = run_test(stage, by_ip)
+            durations.append(duration)
+        if stage == 'dns':
+            by_ip = result != 0
+        duration = statistics.median(durations)
+        limit = scenario['limits'][stage] * factor
+        ok = result in scenario['expected'][stage] and duration <= limit
+        rows.append({'scenario': name, 'test': stage, 'result': result,
+                     'expected': list(scenario['expected'][stage]), 'duration': duration,
+                     'limit': limit, 'ok': ok})
+        if verbose and not ok:
+            print(run.printed_text.getvalue(), file=sys.stderr)
+    return rows
+
+
+def check_dns_failures(simulator):
+    """
+    Check that a DNS query gets an answer when some of the nameservers
+    can't be reached: one of the other address family than the source
+    address, one which truncates its reply over UDP and does not listen
+    on TCP. Return a list of result dicts like run_scenario() does.
+    """
+    simulator.scenario = SCENARIOS['clean']
+    checks = {
+        # The IPv4 source address can't be bound for querying an IPv6 nameserver
+        'dns_af': ([('blocked-a.bench', 'A')], ['::1', SYSTEM_DNS]),
+        'dns_tc': ([(TRUNCATED_NAME, 'A')], [THIRD_PARTY_DNS, SYSTEM_DNS]),
+    }
+    rows = []
+    for name, (questions, nameservers) in checks.items():
+        started = time.perf_counter()
+        try:
+            result = blockcheck.resolver_pool.query_many(questions, nameservers, SYSTEM_DNS, timeout=1)
+            result = result[questions[0]]
+            result = result[1] if isinstance(result, tuple) else type(result).__name__
+        except Exception as e:
+            result = type(e).__name__
+        duration = time.perf_counter() - started
+        rows.append({'scenario': 'failures', 'test': name, 'result': result, 'expected': [SYSTEM_DNS],
+                     'duration': duration, 'limit': 1, 'ok': result == SYSTEM_DNS and duration <= 1})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер скорости тестов BlockCheck на имитации сети провайдера.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Выполнить только этот сценарий (можно указать несколько раз).')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Выполнить каждый тест столько раз и взять медиану времени.')
+    parser.add_argument('--factor', type=float, default=1.0,
+                        help='Умножить допустимое время тестов на это число, например, для медленных машин.')
+    parser.add_argument('--json', action='store_true', help='Вывести результаты в формате JSON.')
+    parser.add_argument('--verbose', action='store_true', help='Показать вывод не прошедших тестов.')
+    args = parser.parse_args()
+
+    blockcheck.tkusable = False
+    with tempfile.TemporaryDirectory() as workdir:
+        simulator = Simulator(workdir)
+        simulator.start()
+        try:
+            rows = []
+            for name in args.scenario or SCENARIOS:
+                rows.extend(run_scenario(simulator, name, args.repeat, args.factor, args.verbose))
+            rows.extend(check_dns_failures(simulator))
+        finally:
+            simulator.stop()
+
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print("{:<8} {:<6} {:>10} {:>10} {:>9} {:>9}".format('сценарий', 'тест', 'результат', 'ожидался',
+                                                            'время, с', 'предел, с'))
+        for row in rows:
+            print("{:<8} {:<6} {:>10} {:>10} {:>9.3f} {:>9.1f} {}".format(
+                row['scenario'], row['test'], row['result'], '/'.join(map(str, row['expected'])),
+                row['duration'], row['limit'], 'OK' if row['ok'] else 'РЕГРЕССИЯ'))
+    return 0 if all(row['ok'] for row in rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,70 @@
 #!/usr/bin/env python3
 # coding: utf-8
+import time
+_load_started = time.perf_counter()  # See --startup-profile
 import argparse
+import base64
+import builtins
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import importlib
+import importlib.util
 import json
-import urllib.request
+import queue
+import select
 import urllib.parse
-import urllib.error
 import socket
-import ssl
+import struct
 import sys
 import os.path
-import dns.resolver
-import dns.exception
+import threading
 import ipaddress
-import ipwhois
+
+_imports_done = time.perf_counter()
+# Modules imported by _LazyModule: [(name, seconds since start, seconds spent)]
+_lazy_imports = []
+
+
+class _LazyModule():
+    """
+    Module which is imported on first access to its attributes.
+    `submodules` are imported along with it, so that e.g. dns.resolver
+    works on a lazy `dns`.
+    """
+
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    for submodule in self._submodules:
+                        importlib.import_module(submodule)
+                    _lazy_imports.append((self._name, started - _load_started, time.perf_counter() - started))
+                    self._module = module
+        return getattr(self._module, attr)
+
+
+# Slow to import and not needed by every run, e.g. in the batch mode
+# or in the web interface which do not use tkinter.
+# Add new modules to hiddenimports in blockcheck.spec.
+dns = _LazyModule('dns', ('dns.resolver', 'dns.entropy', 'dns.exception', 'dns.flags', 'dns.inet',
+                          'dns.message', 'dns.query', 'dns.rcode'))
+http = _LazyModule('http', ('http.client',))
+ipwhois = _LazyModule('ipwhois')
+ssl = _LazyModule('ssl')
+tk = _LazyModule('tkinter', ('tkinter.scrolledtext',))
+urllib_request = _LazyModule('urllib.request')
 
 '''
 
@@ -79,6 +131,7 @@ https_list = {'https://rutracker.org/forum/index.php', 'https://lolibooru.moe/',
 
 dpi_list =   {
     # These tests are currently performed only using IPv4. IPv6 field is not used.
+    # Optional 'port' is the HTTP port of the site, 80 by default.
 
     'rutracker.org':
     {'host': 'rutracker.org', 'urn': '/forum/index.php',
@@ -93,6 +146,13 @@ google_dns = '8.8.4.4'
 google_dns_v6 = '2001:4860:4860::8844'
 fake_dns = '3.3.3.3'  # Fake server which should never reply
 fake_dns_v6 = '2600::10:20'
+# Other public DNS servers queried along with Google DNS, see test_dns()
+third_party_dns = ('1.1.1.1', '9.9.9.9')
+third_party_dns_v6 = ('2606:4700:4700::1111', '2620:fe::fe')
+dns_port = 53  # Port of all the DNS servers above and the system ones
+google_dns_tls = ('dns.google', 853)  # Name and port of Google DNS over TLS, connected to at google_dns
+google_doh = 'https://dns.google/dns-query'  # Google DNS over HTTPS (RFC 8484)
+dns_transports = ('tcp', 'tls', 'https')  # Google DNS is also queried over these, see _get_records_over_transport()
 google_dns_api = 'https://dns.google.com/resolve'
 isup_server = 'isitdownrightnow.com'
 isup_fmt = 'https://www.isitdownrightnow.com/check.php?domain={}'
@@ -101,36 +161,441 @@ disable_report = False
 disable_ipv6 = False
 force_ipv6 = False
 force_dpi_check = False
+max_threads = 32  # Upper limit of simultaneously running probes
+dns_stage_timeout = 30  # Shared deadline for all concurrent DNS queries of one stage, seconds
+dns_consensus_prefix = {4: 24, 6: 48}  # Addresses from one such network are the same site for test_dns()
+dns_consensus_asn = True  # So are addresses of one autonomous system, looked up over RDAP
+asn_cache_ttl = 24 * 60 * 60  # Seconds to reuse the autonomous system of an address, see _ip_asn()
+dns_dual_stack = True  # Query A and AAAA records from the system resolver together if IPv6 is available, see _get_dual_stack_records()
+dpi_concurrency = 4  # Simultaneous DPI bypass attempts per target IP
+max_body_size = 1024 * 1024  # Stop reading a page after this many bytes if a marker is searched
+dns_cache_file = None  # File to keep Google API answers in between runs
+json_output = False  # Print results as JSON instead of text
+timings_enabled = False  # Record how long every stage and probe takes
+log_max_size = 1024 * 1024  # Characters of output kept for the report, oldest are dropped first
+debug_log_max_size = 4 * 1024 * 1024  # The same for the output with debug messages
+max_runtime = None  # Seconds a run may take, timeouts of probes are cut to fit; no limit if None
+probe_timeouts = {'dns': 5, 'connect': 10, 'http': 15}  # Upper limits of probe timeouts, seconds
+rtt_probe_addr = (google_dns, 443)  # Known-good host which connect time is the network round-trip time
+rtt_timeout_kinds = ('connect', 'dns')  # Probes which timeouts follow the round-trip time, slow servers get the full 'http' one
+rtt_timeout_factor = 20  # Such timeouts are this many round-trip times...
+min_probe_timeout = 2  # ...but not less than this, seconds
+startup_profile = False  # Print how long imports took, see print_startup_profile()
+batch_file = None  # JSON file with a list of vantage points to check from, see run_vantage()
 
 # End configuration
 
-ipv6_available = False
 debug = False
 web_interface = False
 
-# Something really bad happened, what most likely is a bug: system DNS
-# resolver and Google DNS are unavailable, while IPv6 generally work, and so on.
-# Debug log is sent to server if this variable is True.
-really_bad_fuckup = False
+STAGES = ('dns', 'http', 'https', 'dpi')
+# Keys of run_tests() results every stage fills, see STAGE_FIELDS for RunResult fields
+STAGE_RESULTS = {'dns': ('dns_v4', 'dns_v6'), 'http': ('http_v4', 'http_v6', 'http_isup', 'subdomain_blocked'),
+                 'https': ('https',), 'dpi': ('dpi',)}
+# Stages which results are needed to run a stage: HTTP test checks sites by IP
+# if DNS is spoofed, DPI test is only needed if HTTP is blocked.
+STAGE_DEPENDENCIES = {'dns': (), 'http': ('dns',), 'https': (), 'dpi': ('http',)}
+# Shares of the remaining run time given to a stage and the stages which wait for it
+STAGE_WEIGHTS = {'dns': 1, 'http': 2, 'https': 1, 'dpi': 3}
 
-printed_text = ''
-printed_text_with_debug = ''
-message_to_print = ''
 
-try:
-    import tkinter as tk
-    import tkinter.scrolledtext as tkst
-    import threading
-    import queue
+@dataclasses.dataclass
+class DnsResult:
+    """
+    Result of test_dns(): verdict code (0-5) and addresses returned by
+    every resolver: 'default' (system), 'google_dns', 'google_api',
+    'fake_dns', 'dns_<address>' for every server of `third_party_dns`
+    and Google DNS over every transport of `dns_transports`
+    ('google_tcp', 'google_tls', 'google_https').
+    """
+    family: str
+    verdict: int = None
+    answers: dict = dataclasses.field(default_factory=dict)
+    duration: float = None
+
+
+@dataclasses.dataclass
+class HttpResult:
+    """Result of test_http_access(), see HTTP_ACCESS_* and HTTP_ISUP_* constants."""
+    by_ip: bool
+    verdict_v4: int = None
+    verdict_v6: int = None
+    isup: int = None
+    subdomain_blocked: bool = None
+    sites: list = dataclasses.field(default_factory=list)
+    duration: float = None
+
+
+@dataclasses.dataclass
+class HttpsSiteResult:
+    site: str
+    ip: str = None
+    status: int = None
+    certificate_verified: bool = None
+    isup: bool = None
+
+
+@dataclasses.dataclass
+class HttpsResult:
+    """Result of test_https_cert(), see its return codes."""
+    verdict: int = None
+    sites: list = dataclasses.field(default_factory=list)
+    duration: float = None
+
+
+@dataclasses.dataclass
+class DpiResult:
+    """
+    Result of test_dpi(): outcome of every technique as a list of dicts
+    with 'site', 'technique' and 'outcome' (one of DPI_RESULT_*) keys,
+    and the names of working techniques.
+    """
+    techniques: list = dataclasses.field(default_factory=list)
+    working: list = dataclasses.field(default_factory=list)
+    duration: float = None
+
+
+@dataclasses.dataclass
+class RunResult:
+    """Results of all stages of one run, serializable to JSON."""
+    version: str = VERSION
+    name: str = None
+    source_address: str = None
+    resolver: list = None
+    proxy: str = None
+    ipv6_available: bool = False
+    really_bad_fuckup: bool = False
+    error: str = None
+    rtt: float = None
+    dns_v4: DnsResult = None
+    dns_v6: DnsResult = None
+    http: HttpResult = None
+    https: HttpsResult = None
+    dpi: DpiResult = None
+    timings: list = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
+
+
+# RunResult fields every stage fills: the ones named like its results or
+# else the one named after the stage
+STAGE_FIELDS = {stage: tuple(key for key in keys if key in {field.name for field in dataclasses.fields(RunResult)})
+                or (stage,) for stage, keys in STAGE_RESULTS.items()}
+
+
+def to_ndjson(results):
+    """Serialize an iterable of RunResult to newline-delimited JSON."""
+    return ''.join(result.to_json() + "\n" for result in results)
+
+
+class LogBuffer():
+    """
+    Text log kept as a list of appended pieces which are joined only when
+    the text is requested. If the text grows beyond `max_size` characters,
+    the oldest pieces are dropped.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.pieces = collections.deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+        while self.max_size and self.size > self.max_size and len(self.pieces) > 1:
+            self.size -= len(self.pieces.popleft())
+            self.truncated = True
+
+    def clear(self):
+        self.pieces.clear()
+        self.size = 0
+        self.truncated = False
+
+    def getvalue(self):
+        return ''.join(self.pieces)
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.getvalue()
+
+
+class Timings():
+    """
+    Spans recorded during one run. Every span has a kind ('stage', 'dns',
+    'connect', 'tls', 'ttfb', 'body', ...), a label describing the probe,
+    start time relative to the run start and duration, in seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.spans = []
+
+    def add(self, kind, label, started, duration):
+        with self.lock:
+            self.spans.append({'kind': kind, 'label': label, 'start': round(started - self.started, 6),
+                               'duration': round(duration, 6)})
+
+    def summary(self):
+        """Return {kind: (count, total, max)} of the recorded spans."""
+        summary = {}
+        with self.lock:
+            for span in self.spans:
+                count, total, longest = summary.get(span['kind'], (0, 0, 0))
+                summary[span['kind']] = (count + 1, total + span['duration'], max(longest, span['duration']))
+        return summary
+
+
+class _Span():
+    def __init__(self, timings, kind, label):
+        self.timings = timings
+        self.kind = kind
+        self.label = label
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.kind, self.label, self.started, time.monotonic() - self.started)
+
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def _span(kind, label=None):
+    """
+    Return a context manager measuring the time of its block as a span
+    of the current run. Does nothing unless `timings_enabled` is set.
+    """
+    if not timings_enabled:
+        return _no_span
+    return _Span(_run().timings, kind, label)
 
-    tkusable = True
-    if not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
-        tkusable = False
+
+class RunContext():
+    """
+    State of one run of the tests.
+
+    Every thread works with the run set in its context (see _run()),
+    worker threads started by the probes inherit it. The optional
+    `source_address`, `resolver` (list of DNS servers used instead of the
+    system ones) and `proxy` describe the vantage point the run checks from.
+    """
+
+    def __init__(self, name=None, source_address=None, resolver=None, proxy=None, stages=STAGES,
+                 quiet=False):
+        self.name = name
+        self.source_address = source_address
+        self.resolver = resolver
+        self.proxy = proxy
+        self.stages = stages
+        self.quiet = quiet  # Do not write to the console
+
+        self.ipv6_available = False
+        # Something really bad happened, what most likely is a bug: system DNS
+        # resolver and Google DNS are unavailable, while IPv6 generally work, and so on.
+        # Debug log is sent to server if this variable is True.
+        self.really_bad_fuckup = False
+        # Future of the IPv6 tunnel check started by main(), see settle_ipv6()
+        self.ipv6_pending = None
+        self.ipv6_lock = threading.Lock()
+        self.deadline = None  # time.monotonic() the run should be over by, see set_deadline()
+        self.rtt = None  # Network round-trip time, see measure_rtt()
+
+        self.printed_text = LogBuffer(log_max_size)
+        self.printed_text_with_debug = LogBuffer(debug_log_max_size)
+        self.message_to_print = LogBuffer(log_max_size)
+        # Outcomes of the last DPI test: {(dpi_list key, technique name): DPI_RESULT_*}
+        self.dpi_result_table = {}
+        self.results = RunResult(name=name, source_address=source_address, resolver=resolver, proxy=proxy)
+        self.timings = Timings()
+        # Queues of the subscribers to the progress of the run, see subscribe()
+        self.listeners = []
+        self.events = []  # Emitted events except printed lines, replayed to late subscribers
+        # Results of the stages run by run_tests(), which may be passed to it as `cached` later
+        self.stage_results = {}
+        # Futures of A and AAAA records queried together, see _get_dual_stack_records()
+        self.dual_stack_records = {}
+        self.dual_stack_lock = threading.Lock()
+        # Addresses which autonomous system could not be looked up, not tried again, see _ip_asns()
+        self.asn_failures = set()
+
+    def reset_logs(self):
+        self.printed_text.clear()
+        self.printed_text_with_debug.clear()
+        self.message_to_print.clear()
+        self.events.clear()
+        self.stage_results.clear()
+
+    def set_deadline(self, seconds):
+        """Make the run be over in `seconds` from now, no limit if None, see _timeout()."""
+        self.deadline = time.monotonic() + seconds if seconds else None
+
+    def settle_ipv6(self):
+        """
+        Wait for the pending IPv6 tunnel check and disable IPv6 if it is tunneled.
+        Stages running concurrently may call this, all of them wait.
+        """
+        with self.ipv6_lock:
+            pending, self.ipv6_pending = self.ipv6_pending, None
+            if pending is None:
+                return
+            tunneled, lines = pending.result()
+            _replay(lines)
+            if tunneled:
+                self.ipv6_available = False
+                print("Вероятно, у вас IPv6-туннель. Проверка IPv6 отключена.")
+
+    def subscribe(self):
+        """
+        Return a queue receiving (event, data) tuples of the run as they happen:
+        ('line', text) for every printed line, ('stage', results) when a test
+        stage completes (see run_tests()) and ('done', None) when run_vantage()
+        is over.
+        What was printed and emitted before comes first as one 'line' event
+        followed by the past events.
+        """
+        listener = queue.Queue()
+        with print_lock:
+            backlog = self.printed_text.getvalue()
+            if backlog:
+                listener.put(('line', backlog))
+            for event in self.events:
+                listener.put(event)
+            self.listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with print_lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def emit(self, event, data=None):
+        with print_lock:
+            if event != 'line':
+                self.events.append((event, data))
+            for listener in self.listeners:
+                listener.put((event, data))
+
+
+default_run = RunContext()
+_current_run = contextvars.ContextVar('blockcheck_run')
+
+
+def _run():
+    """Return the RunContext of the current thread."""
+    return _current_run.get(default_run)
+
+
+@contextlib.contextmanager
+def use_run(run):
+    """Make `run` the current run of this thread within the block."""
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+
+
+# Deadline of the stage the current thread works for, see run_tests()
+_stage_deadline = contextvars.ContextVar('blockcheck_stage_deadline', default=None)
+
+
+def _time_left():
+    """Return seconds left till the deadline of the current stage or run, None if there is none."""
+    deadline = _stage_deadline.get()
+    if deadline is None:
+        deadline = _run().deadline
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def _timeout(kind):
+    """
+    Return timeout for a probe of `kind` (a key of `probe_timeouts`) cut to
+    the time left: for kinds in `rtt_timeout_kinds` a multiple of the measured
+    round-trip time within the limits, for others the limit itself.
+    """
+    timeout = probe_timeouts[kind]
+    rtt = _run().rtt
+    if rtt is not None and kind in rtt_timeout_kinds:
+        timeout = min(timeout, max(min_probe_timeout, rtt * rtt_timeout_factor))
+    left = _time_left()
+    if left is not None:
+        # Out of time probes still run, but fail fast
+        timeout = min(timeout, max(left, 0.1))
+    return timeout
+
+
+def __getattr__(name):
+    # Keep blockcheck.ipv6_available and friends working for importers
+    if name in ('printed_text', 'printed_text_with_debug', 'message_to_print'):
+        return getattr(_run(), name).getvalue()
+    if name in ('ipv6_available', 'really_bad_fuckup', 'dpi_result_table'):
+        return getattr(_run(), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+# Probes run in worker threads, so output buffers are modified under this lock.
+print_lock = threading.RLock()
+
+
+class _Capture():
+    """
+    Output collected instead of being printed, a list of (debug_only, text)
+    `lines`, see _captured(). Once `live`, the output goes on to the
+    `parent` capture, or is printed if there is none.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.lines = []
+        self.live = False
+        self.printed = False  # Whether anything but debug messages went on while live
 
 
-    class ThreadSafeConsole(tkst.ScrolledText):
+# Capture of the output of the current thread and the threads it starts, see _submit()
+_output_capture = contextvars.ContextVar('blockcheck_output_capture', default=None)
+
+
+def _capture_target(shown=True):
+    """Return the _Capture collecting output printed now, None if it should be printed."""
+    capture = _output_capture.get()
+    while capture is not None and capture.live:
+        capture.printed = capture.printed or shown
+        capture = capture.parent
+    return capture
+
+tkusable = True
+if not importlib.util.find_spec('_tkinter') or not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+    tkusable = False
+
+
+@functools.lru_cache(maxsize=None)
+def _thread_safe_console():
+    """Return ThreadSafeConsole class, it is defined on first use to import tkinter only then."""
+
+    class ThreadSafeConsole(tk.scrolledtext.ScrolledText):
         def __init__(self, master, **options):
-            tkst.ScrolledText.__init__(self, master, **options)
+            tk.scrolledtext.ScrolledText.__init__(self, master, **options)
             self.queue = queue.Queue()
             self.update_me()
 
@@ -154,17 +619,13 @@ try:
                 pass
             self.after(100, self.update_me)
 
+    return ThreadSafeConsole
 
-    def tk_terminate():
-        root.destroy()
-        raise SystemExit
-
-except ImportError:
-    tkusable = False
 
+def tk_terminate():
+    root.destroy()
+    raise SystemExit
 
-    class ThreadSafeConsole():
-        pass
 
 trans_table = str.maketrans("⚠✗✓«»", '!XV""')
 
@@ -187,209 +648,922 @@ def print_string(*args, **kwargs):
 
 
 def print(*args, **kwargs):
-    global printed_text, printed_text_with_debug, message_to_print
-    if tkusable:
+    with print_lock:
+        capture = _capture_target()
+        if capture is not None:
+            capture.lines.append((False, print_string(*args, **kwargs)))
+            return
+        _print(*args, **kwargs)
+
+
+def _print(*args, **kwargs):
+    run = _run()
+    if tkusable and not run.quiet:
         this_text = print_string(*args, **kwargs)
         text.write(this_text)
-        printed_text += this_text
-        printed_text_with_debug += this_text
+        run.printed_text.append(this_text)
+        run.printed_text_with_debug.append(this_text)
+        run.emit('line', this_text)
     else:
         if web_interface:
-            message_to_print += print_string(*args, **kwargs) + "<br>"
+            run.message_to_print.append(print_string(*args, **kwargs) + "<br>")
 
         if args and sys.stdout.encoding != 'UTF-8':
             args = [x.translate(trans_table).replace("[☠]", "[FAIL]").replace("[☺]", "[:)]"). \
                         encode(sys.stdout.encoding, 'replace').decode(sys.stdout.encoding) for x in args
                     ]
-        if not web_interface:
-            __builtins__.print(*args, **kwargs)
+        if not web_interface and not run.quiet:
+            builtins.print(*args, **kwargs)
         this_text = print_string(*args, **kwargs)
-        printed_text += this_text
-        printed_text_with_debug += this_text
+        run.printed_text.append(this_text)
+        run.printed_text_with_debug.append(this_text)
+        run.emit('line', this_text)
 
 
 def print_debug(*args, **kwargs):
-    global printed_text_with_debug
-    this_text = print_string(*args, **kwargs)
-    printed_text_with_debug += this_text
-    if debug:
-        print(*args, **kwargs)
+    with print_lock:
+        this_text = print_string(*args, **kwargs)
+        capture = _capture_target(False)
+        if capture is not None:
+            capture.lines.append((True, this_text))
+            return
+        _run().printed_text_with_debug.append(this_text)
+        if debug:
+            print(*args, **kwargs)
+
+
+def _collecting(capture, func, *args):
+    """Call `func` with everything it and the threads it starts print going to `capture`."""
+    token = _output_capture.set(capture)
+    try:
+        return func(*args)
+    finally:
+        _output_capture.reset(token)
+
+
+def _captured(func, *args):
+    """
+    Call `func` with collecting everything it prints instead of printing it.
+    Return a tuple of the result and the collected output which could be
+    passed to _replay() afterwards.
+    """
+    capture = _Capture(_output_capture.get())
+    try:
+        result = _collecting(capture, func, *args)
+    finally:
+        with print_lock:
+            # Threads of `func` which are still running print as usual
+            capture.live = True
+    return result, capture.lines
+
+
+def _replay(lines):
+    for debug_only, this_text in lines:
+        if debug_only:
+            print_debug(this_text, end='')
+        else:
+            print(this_text, end='')
 
 
 def really_bad_fuckup_happened():
-    global really_bad_fuckup
-    really_bad_fuckup = True
+    _run().really_bad_fuckup = True
 
 
-def _get_a_record(site, querytype='A', dnsserver=None):
-    resolver = dns.resolver.Resolver()
-    resolver.timeout = 5
-    resolver.lifetime = 5
+class ResolverPool():
+    """
+    Sends DNS queries over UDP sockets which are reused between queries.
+
+    A query is sent to all the nameservers at once and the first valid
+    reply wins, so a dead nameserver costs nothing while another one works.
+    Replies to earlier queries which arrive late are told apart by their
+    ID and dropped.
+    """
 
+    # A reply with these codes is not an answer, wait for other nameservers
+    FAILED_RCODES = ('SERVFAIL', 'REFUSED', 'NOTIMP')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sockets = {}
+        self.system_nameservers = None
+
+    def nameservers(self):
+        """Return the system nameservers, resolv.conf is read only once."""
+        if self.system_nameservers is None:
+            self.system_nameservers = list(dns.resolver.get_default_resolver().nameservers)
+        return self.system_nameservers
+
+    def _acquire(self, family, source):
+        with self.lock:
+            free = self.sockets.get((family, source))
+            if free:
+                return free.pop()
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            if source:
+                sock.bind((source, 0))
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _release(self, family, source, sock):
+        with self.lock:
+            self.sockets.setdefault((family, source), []).append(sock)
+
+    def close(self):
+        with self.lock:
+            sockets, self.sockets = self.sockets, {}
+        for free in sockets.values():
+            for sock in free:
+                sock.close()
+
+    @staticmethod
+    def _make_requests(questions):
+        """Return a dict of {question: query} with unique IDs for `questions`, a list of (qname, querytype)."""
+        requests = {}
+        for question in questions:
+            request = dns.message.make_query(*question)
+            while request.id in (other.id for other in requests.values()):
+                request.id = dns.entropy.random_16()
+            requests[question] = request
+        return requests
+
+    def query_many(self, questions, nameservers, source=None, timeout=5):
+        """
+        Send queries for all `questions`, a list of (qname, querytype), to all
+        `nameservers` at once over the same sockets. Return a dict of
+        {question: (response, nameserver)} with the first valid response
+        to every question. Truncated responses are repeated over TCP.
+        A question is mapped to dns.exception.Timeout instead if no
+        nameserver answered it in `timeout` seconds and to
+        dns.resolver.NoNameservers if all of them failed.
+        """
+        requests = self._make_requests(questions)
+        by_id = {request.id: question for question, request in requests.items()}
+        addresses = {ipaddress.ip_address(nameserver): nameserver for nameserver in nameservers}
+        pending = {question: set(addresses) for question in requests}
+        errors = {question: [] for question in requests}
+        results = {}
+        expiration = time.monotonic() + timeout
+        sockets = {}
+        try:
+            for nameserver in nameservers:
+                family = dns.inet.af_for_address(nameserver)
+                try:
+                    # Binding fails if `source` is of the other family
+                    if family not in sockets:
+                        sockets[family] = self._acquire(family, source)
+                    for request in requests.values():
+                        sockets[family].sendto(request.to_wire(), (nameserver, dns_port))
+                except OSError as e:
+                    print_debug("Can't send DNS query to", nameserver, repr(e))
+                    for question, waiting in pending.items():
+                        waiting.discard(ipaddress.ip_address(nameserver))
+                        errors[question].append((nameserver, False, dns_port, e, None))
+
+            while any(pending.values()):
+                left = expiration - time.monotonic()
+                if left <= 0:
+                    break
+                for sock in select.select(list(sockets.values()), [], [], left)[0]:
+                    try:
+                        wire, address = sock.recvfrom(65535)
+                        response = dns.message.from_wire(wire)
+                    except (OSError, dns.exception.DNSException):
+                        continue
+                    question = by_id.get(response.id)
+                    address = ipaddress.ip_address(address[0].split('%')[0])
+                    if question is None or address not in pending[question] \
+                            or not requests[question].is_response(response):
+                        continue
+                    pending[question].discard(address)
+                    nameserver = addresses[address]
+                    if response.flags & dns.flags.TC:
+                        try:
+                            response = dns.query.tcp(requests[question], nameserver,
+                                                     max(expiration - time.monotonic(), 0.1), dns_port, source)
+                        except (OSError, EOFError, dns.exception.DNSException) as e:
+                            print_debug("DNS over TCP to", nameserver, repr(e))
+                            errors[question].append((nameserver, True, dns_port, e, None))
+                            continue
+                    rcode = dns.rcode.to_text(response.rcode())
+                    if rcode in self.FAILED_RCODES:
+                        errors[question].append((nameserver, False, dns_port, rcode, response))
+                        continue
+                    results[question] = (response, nameserver)
+                    pending[question].clear()
+        finally:
+            for family, sock in sockets.items():
+                self._release(family, source, sock)
+
+        for question, request in requests.items():
+            if question in results:
+                continue
+            if pending[question]:
+                results[question] = dns.exception.Timeout(timeout=timeout)
+            else:
+                results[question] = dns.resolver.NoNameservers(request=request, errors=errors[question])
+        return results
+
+    def query_stream(self, questions, nameserver, port, server_name=None, source=None, timeout=5):
+        """
+        Send queries for all `questions` to `nameserver` over one TCP
+        connection, without waiting for the responses in between (RFC 7766).
+        The connection is wrapped in TLS if `server_name` of the server
+        is given, which is DNS over TLS (RFC 7858).
+        Return a dict like query_many() does.
+        """
+        requests = self._make_requests(questions)
+        by_id = {request.id: question for question, request in requests.items()}
+        results = {}
+        expiration = time.monotonic() + timeout
+        try:
+            sock = socket.create_connection((nameserver, port), timeout, (source, 0) if source else None)
+            try:
+                if server_name:
+                    # Takes over the connection, so this is what to close then
+                    sock = http_client.context(True).wrap_socket(sock, server_hostname=server_name)
+                sock.sendall(b''.join(struct.pack('!H', len(wire)) + wire
+                                      for wire in (request.to_wire() for request in requests.values())))
+                while len(results) < len(requests):
+                    sock.settimeout(max(expiration - time.monotonic(), 0.01))
+                    wire = _recv_exactly(sock, struct.unpack('!H', _recv_exactly(sock, 2))[0])
+                    response = dns.message.from_wire(wire)
+                    question = by_id.get(response.id)
+                    if question is not None and requests[question].is_response(response):
+                        results[question] = (response, nameserver)
+            finally:
+                sock.close()
+        except socket.timeout:
+            error = dns.exception.Timeout(timeout=timeout)
+        except (OSError, EOFError, dns.exception.DNSException) as e:
+            error = e
+        else:
+            return results
+        print_debug("DNS over {} to {}: {}".format('TLS' if server_name else 'TCP', nameserver, repr(error)))
+        for question, request in requests.items():
+            if question not in results:
+                results[question] = error if isinstance(error, dns.exception.Timeout) else \
+                    dns.resolver.NoNameservers(request=request, errors=[(nameserver, True, port, error, None)])
+        return results
+
+    def query(self, qname, querytype, nameservers, source=None, timeout=5):
+        """
+        Send a `querytype` query for `qname`, see query_many(). Return
+        a tuple of the response and the nameserver or raise the exception.
+        """
+        result = self.query_many([(qname, querytype)], nameservers, source, timeout)[(qname, querytype)]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+resolver_pool = ResolverPool()
+
+
+def _recv_exactly(sock, size):
+    """Read `size` bytes from `sock`, raise EOFError if it is closed before."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _get_dual_stack_records(site, nameservers):
+    """
+    Query A and AAAA records of `site` at once, pipelined over the same
+    socket, and return a dict of {querytype: result of ResolverPool.query_many()}.
+    The result is kept for the whole run, so IPv4 and IPv6 tests which
+    resolve the same names share one round-trip.
+    """
+    run = _run()
+    key = (site.lower(), tuple(nameservers))
+    with run.dual_stack_lock:
+        future = run.dual_stack_records.get(key)
+        querying = future is None
+        if querying:
+            future = run.dual_stack_records[key] = concurrent.futures.Future()
+    if querying:
+        try:
+            with _span('dns', "{} A+AAAA @{}".format(site, ','.join(nameservers))):
+                results = resolver_pool.query_many([(site, 'A'), (site, 'AAAA')], nameservers,
+                                                   run.source_address, _timeout('dns'))
+            future.set_result({querytype: result for (qname, querytype), result in results.items()})
+        except BaseException as e:
+            future.set_exception(e)
+    return future.result()
+
+
+def _get_a_record(site, querytype='A', dnsserver=None):
+    run = _run()
     if dnsserver:
-        resolver.nameservers = [dnsserver]
+        nameservers = [dnsserver]
+    else:
+        nameservers = list(run.resolver or resolver_pool.nameservers())
 
-    result = []
-    while len(resolver.nameservers):
+    # The IPv6 tests query other nameservers than the IPv4 ones, except for the system resolver
+    if dns_dual_stack and run.ipv6_available and querytype in ('A', 'AAAA') and not dnsserver:
+        result = _get_dual_stack_records(site, nameservers)[querytype]
+    else:
+        with _span('dns', "{} {} @{}".format(site, querytype, ','.join(nameservers))):
+            result = resolver_pool.query_many([(site, querytype)], nameservers, run.source_address,
+                                              _timeout('dns'))[(site, querytype)]
+    if isinstance(result, dns.exception.Timeout):
+        print_debug("DNS Timeout for", site, "using", ', '.join(nameservers))
+        # If all the requests failed
+        return ""
+    if isinstance(result, Exception):
+        raise result
+    return _answer_records(*result)
+
+
+def _answer_records(response, nameserver):
+    """
+    Return the records of the answer to the query `response` was sent for,
+    following CNAMEs. Raise dns.resolver.NXDOMAIN or NoAnswer if there are none.
+    """
+    print_debug(str(response))
+    question = response.question[0]
+    if response.rcode() == dns.rcode.NXDOMAIN:
+        raise dns.resolver.NXDOMAIN(qnames=[question.name], responses={question.name: response})
+    answer = dns.resolver.Answer(question.name, question.rdtype, question.rdclass, response, nameserver, dns_port)
+    if answer.rrset is None:
+        raise dns.resolver.NoAnswer(response=response)
+    return [item.to_text() for item in answer.rrset.items]
+
+
+def _query_doh(questions, timeout=5):
+    """
+    Send queries for all `questions` to `google_doh` in RFC 8484 wire format
+    over one keep-alive connection of http_client and return a dict like
+    ResolverPool.query_many() does.
+    All the queries share `timeout`, and the rest of them are not sent
+    once the connection fails.
+    """
+    results = {}
+    expiration = time.monotonic() + timeout
+    failure = None
+    for question in questions:
+        request = dns.message.make_query(*question)
+        request.id = 0  # Recommended by RFC 8484 for caching
+        url = google_doh + '?dns=' + base64.urlsafe_b64encode(request.to_wire()).decode().rstrip('=')
+        left = expiration - time.monotonic()
+        if failure is None and left <= 0:
+            failure = socket.timeout()
         try:
-            resolved = resolver.resolve(site, querytype)
-            print_debug(str(resolved.response))
-            for item in resolved.rrset.items:
-                result.append(item.to_text())
-            return result
+            if failure is not None:
+                raise failure
+            try:
+                status, headers, body, peer = http_client.request(url, follow_redirects=False, timeout=left)
+            except (http.client.HTTPException, OSError) as e:
+                failure = e
+                raise
+            if status != 200:
+                raise dns.exception.DNSException("HTTP status {}".format(status))
+            response = dns.message.from_wire(body)
+            if not request.is_response(response):
+                raise dns.exception.DNSException("Response does not match the query")
+            results[question] = (response, google_doh)
+        except socket.timeout:
+            results[question] = dns.exception.Timeout(timeout=timeout)
+        except (http.client.HTTPException, OSError, dns.exception.DNSException) as e:
+            print_debug("DNS over HTTPS:", repr(e))
+            results[question] = dns.resolver.NoNameservers(request=request,
+                                                           errors=[(google_doh, True, 443, e, None)])
+    return results
+
+
+def _get_records_over_transport(transport, sitelist, querytype='A'):
+    """
+    Resolve all of `sitelist` through Google DNS over one connection of
+    `transport`: 'tcp' for DNS over TCP, 'tls' for DNS over TLS and
+    'https' for DNS over HTTPS. Return a dict of {site: sorted list of
+    records}, which is empty if the transport does not work.
+    """
+    run = _run()
+    questions = [(site, querytype) for site in sitelist]
+    server = google_dns if querytype == 'A' else google_dns_v6
+    with _span('dns', "{} {} over {}".format(len(sitelist), querytype, transport)):
+        if transport == 'https':
+            results = _query_doh(questions, _timeout('dns'))
+        elif transport == 'tls':
+            results = resolver_pool.query_stream(questions, server, google_dns_tls[1], google_dns_tls[0],
+                                                 run.source_address, _timeout('dns'))
+        else:
+            results = resolver_pool.query_stream(questions, server, dns_port, None, run.source_address,
+                                                 _timeout('dns'))
+    records = {}
+    for (site, querytype), result in results.items():
+        try:
+            if isinstance(result, Exception):
+                raise result
+            records[site] = sorted(_answer_records(*result))
+        except dns.exception.DNSException as e:
+            print_debug("DNS over {} for {}: {}".format(transport, site, repr(e)))
+    return records
 
-        except dns.exception.Timeout:
-            print_debug("DNS Timeout for", site, "using", resolver.nameservers[0])
-            resolver.nameservers.remove(resolver.nameservers[0])
 
-    # If all the requests failed
-    return ""
+class ResolverCache():
+    """
+    Cache of resolved records which honours their TTL.
 
+    Concurrent lookups of the same key are coalesced: only the first
+    caller fetches the records, others wait for its result.
+    The cache may be saved to a JSON file and loaded in the next run.
+    """
 
-def _get_a_record_over_google_api(site, querytype='A'):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.inflight = {}
+
+    def get(self, key, fetch):
+        """
+        Return cached records for `key` (a tuple of strings) or call `fetch`.
+        `fetch` returns a tuple of records and their TTL in seconds,
+        TTL is None if the records should not be cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                return list(entry[1])
+            future = self.inflight.get(key)
+            fetching = future is None
+            if fetching:
+                future = self.inflight[key] = concurrent.futures.Future()
+
+        if not fetching:
+            return list(future.result())
+
+        try:
+            records, ttl = fetch()
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            if ttl is not None:
+                self.entries[key] = (time.time() + ttl, records)
+            del self.inflight[key]
+        future.set_result(records)
+        return list(records)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def load(self, filename):
+        try:
+            with open(filename, encoding='utf-8') as cachefile:
+                entries = json.load(cachefile)
+        except (OSError, ValueError) as e:
+            print_debug("Can't load DNS cache:", repr(e))
+            return
+        now = time.time()
+        with self.lock:
+            for entry in entries:
+                if entry['expires'] > now:
+                    self.entries[tuple(entry['key'])] = (entry['expires'], entry['records'])
+
+    def save(self, filename):
+        now = time.time()
+        with self.lock:
+            entries = [{'key': key, 'expires': expires, 'records': records}
+                       for key, (expires, records) in self.entries.items() if expires > now]
+        try:
+            with open(filename, 'w', encoding='utf-8') as cachefile:
+                json.dump(entries, cachefile)
+        except OSError as e:
+            print_debug("Can't save DNS cache:", repr(e))
+
+
+google_api_cache = ResolverCache()
+
+
+def _fetch_a_record_over_google_api(site, querytype):
     result = []
 
-    response = _get_url(google_dns_api + "?name={}&type={}".format(site, querytype))
+    with _span('doh', "{} {}".format(site, querytype)):
+        response = _get_url(google_dns_api + "?name={}&type={}".format(site, querytype))
     print_debug("Google API: {}".format(response))
     if (response[0] != 200):
-        return ''
+        return '', None
     response_js = json.loads(response[1])
+    ttl = None
     try:
         for dnsanswer in response_js['Answer']:
             if dnsanswer['type'] in (1, 28):
                 result.append(dnsanswer['data'])
+                ttl = min(ttl, dnsanswer['TTL']) if ttl is not None else dnsanswer['TTL']
     except KeyError:
         pass
-    return result
+    if ttl is None:
+        # Negative answer, cache it for the SOA TTL
+        ttl = min([authority.get('TTL', 0) for authority in response_js.get('Authority', [])] or [0])
+    return result, ttl
 
 
-def _get_a_records(sitelist, querytype='A', dnsserver=None, googleapi=False):
-    result = []
-    for site in sorted(sitelist):
-        try:
-            if googleapi:
-                responses = _get_a_record_over_google_api(site, querytype)
-                print_debug("Google API вернул {}".format(responses))
-            else:
-                responses = _get_a_record(site, querytype, dnsserver)
-
-            for item in responses:
-                result.append(item)
-        except dns.resolver.NXDOMAIN:
-            print(
-                "[!] Невозможно получить DNS-запись для домена {} (NXDOMAIN). Результаты могут быть неточными.".format(
-                    site))
-        except dns.resolver.NoAnswer:
-            print_debug("DNS NoAnswer:", site)
-        except dns.exception.DNSException as e:
-            print_debug("DNSException:", str(e))
-            really_bad_fuckup_happened()
+def _get_a_record_over_google_api(site, querytype='A'):
+    return google_api_cache.get((site.lower(), querytype),
+                                functools.partial(_fetch_a_record_over_google_api, site, querytype))
 
-    return sorted(result)
+
+def _submit(executor, func, *args):
+    """Submit `func` to `executor` to be run in the context of the current run."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def _run_concurrently(jobs, timeout=None, max_workers=None):
+    """
+    Run `jobs`, a dict of {key: (function, args)}, in a thread pool and
+    return a dict of {key: result}.
+
+    All jobs are started at once (up to `max_threads`) and share one
+    deadline of `timeout` seconds. Jobs which did not finish in time are
+    left running in background and are missing from the result.
+    Exceptions raised by a job are re-raised.
+    """
+    if not jobs:
+        return {}
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers or len(jobs), max_threads))
+    try:
+        futures = {_submit(executor, func, *args): key for key, (func, args) in jobs.items()}
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        for future in not_done:
+            print_debug("Job {} did not finish in time".format(futures[future]))
+        return {futures[future]: future.result() for future in done}
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _imap_concurrently(func, argslist, max_workers=None):
+    """
+    Run `func` for every tuple of arguments from `argslist` concurrently
+    and yield the results in the order of `argslist`, each one as soon as
+    it and all the preceding ones are ready.
+    """
+    argslist = list(argslist)
+    if not argslist:
+        return
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers or len(argslist), max_threads))
+    try:
+        futures = [_submit(executor, func, *args) for args in argslist]
+        for future in futures:
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _get_a_records_single(site, querytype='A', dnsserver=None, googleapi=False):
+    try:
+        if googleapi:
+            responses = _get_a_record_over_google_api(site, querytype)
+            print_debug("Google API вернул {}".format(responses))
+        else:
+            responses = _get_a_record(site, querytype, dnsserver)
+        return list(responses)
+    except dns.resolver.NXDOMAIN:
+        print(
+            "[!] Невозможно получить DNS-запись для домена {} (NXDOMAIN). Результаты могут быть неточными.".format(
+                site))
+    except dns.resolver.NoAnswer:
+        print_debug("DNS NoAnswer:", site)
+    except dns.exception.DNSException as e:
+        print_debug("DNSException:", str(e))
+        really_bad_fuckup_happened()
+    return []
+
+
+def _get_a_records_many(passes, timeout=None, by_site=False):
+    """
+    Resolve several lists of sites at once.
+
+    `passes` is a dict of {name: (sitelist, querytype, dnsserver, googleapi)}.
+    Every (site, resolver, querytype) query is sent simultaneously and all
+    of them share `timeout` (`dns_stage_timeout` by default), so the whole
+    batch takes as long as the slowest single query.
+    Returns a dict of {name: sorted list of records}, or of
+    {name: {site: sorted list of records}} if `by_site` is True.
+    """
+    jobs = {}
+    for name, (sitelist, querytype, dnsserver, googleapi) in passes.items():
+        for site in sitelist:
+            jobs[(name, site)] = (_get_a_records_single, (site, querytype, dnsserver, googleapi))
+
+    if timeout is None:
+        timeout = dns_stage_timeout
+        if _time_left() is not None:
+            timeout = min(timeout, _time_left())
+    responses = _run_concurrently(jobs, timeout)
+
+    if by_site:
+        result = {name: {} for name in passes}
+        for (name, site), items in responses.items():
+            result[name][site] = sorted(items)
+        return result
+
+    result = {name: [] for name in passes}
+    for (name, site), items in responses.items():
+        result[name].extend(items)
+    return {name: sorted(items) for name, items in result.items()}
+
+
+def _get_a_records(sitelist, querytype='A', dnsserver=None, googleapi=False):
+    return _get_a_records_many({0: (sitelist, querytype, dnsserver, googleapi)})[0]
 
 
 def _decode_bytes(input_bytes):
     return input_bytes.decode(errors='replace')
 
 
-def _get_url(url, proxy=None, ip=None, headers=False, follow_redirects=True):
-    class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
-        def http_error_302(self, req, fp, code, msg, headers):
-            infourl = urllib.response.addinfourl(fp, headers, req.get_full_url())
-            infourl.status = code
-            infourl.code = code
-            return infourl
-
-        http_error_300 = http_error_302
-        http_error_301 = http_error_302
-        http_error_303 = http_error_302
-        http_error_307 = http_error_302
-
-    parsed_url = list(urllib.parse.urlsplit(url))
-    host = parsed_url[1]
-
-    if parsed_url[0].lower() == "https":
-        # Manually check certificate as we may need to connect by IP later
-        # and handling certificate check in urllib is painful and invasive
-        context_hostname_check = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        context_hostname_check.verify_mode = ssl.CERT_REQUIRED
-        conn = context_hostname_check.wrap_socket(socket.socket(socket.AF_INET6 if \
-                                                                    (':' in ip if ip else False) else socket.AF_INET),
-                                                  server_hostname=host)
-        conn.settimeout(10)
-        print_debug("_get_url: connecting over " + ('IPv6' if \
-                                                        (':' in ip if ip else False) else 'IPv4'))
-        try:
-            conn.connect((ip if ip else host, 443))
-        except (ssl.CertificateError) as e:
-            print_debug("_get_url: ssl.CertificateError", repr(e))
-            return (-1, '')
-        except (ssl.SSLError, socket.timeout, socket.error) as e:
-            print_debug("_get_url: socket exception", repr(e))
-            if 'CERTIFICATE_VERIFY_FAILED' in str(e):
-                return (-1, '')
-            return (0, '')
-        finally:
-            try:
-                conn.shutdown(socket.SHUT_RDWR)
-            except Exception:
-                pass
+def _read_until(response, lookfor, max_size):
+    """
+    Read the body of `response` chunk by chunk until one of `lookfor`
+    markers (a string or a tuple of strings) is found or `max_size` bytes
+    are read. Return the bytes read so far.
+    """
+    markers = [marker.encode() for marker in ((lookfor,) if isinstance(lookfor, str) else lookfor)]
+    longest = max(len(marker) for marker in markers)
+    read = getattr(response, 'read1', response.read)
+    body = bytearray()
+    while len(body) < max_size:
+        chunk = read(min(16384, max_size - len(body)))
+        if not chunk:
+            break
+        # A marker may be split between two chunks
+        search_from = max(0, len(body) - longest + 1)
+        body += chunk
+        if any(body.find(marker, search_from) != -1 for marker in markers):
+            break
+    return bytes(body)
+
+
+@functools.lru_cache(maxsize=None)
+def _connection_classes():
+    """
+    Return connection classes used by HTTPClient, they are defined
+    on first use to import http.client and ssl only then.
+    """
+
+    class _HTTPConnection(http.client.HTTPConnection):
+        """HTTP connection which measures its connect time."""
+
+        def connect(self):
+            with _span('connect', "{}:{}".format(self.host, self.port)):
+                http.client.HTTPConnection.connect(self)
+
+    class _HTTPSConnection(http.client.HTTPSConnection):
+        """
+        HTTPS connection which may connect to an IP address while sending
+        another name in SNI, and resume a previous TLS session.
+        """
+
+        def __init__(self, host, port, server_hostname, session=None, **kwargs):
+            http.client.HTTPSConnection.__init__(self, host, port, **kwargs)
+            self.server_hostname = server_hostname
+            self.session = session
+
+        def connect(self):
+            with _span('connect', "{}:{}".format(self.host, self.port)):
+                http.client.HTTPConnection.connect(self)
+            with _span('tls', "{}:{} ({})".format(self.host, self.port, self.server_hostname)):
+                self.sock = self._context.wrap_socket(self.sock, server_hostname=self.server_hostname,
+                                                      session=self.session)
+
+    return _HTTPConnection, _HTTPSConnection
+
+
+class HTTPClient():
+    """
+    HTTP(S) client shared by all probes.
+
+    SSL contexts are created once, idle keep-alive connections are pooled
+    by (scheme, address, port, SNI, proxy, verification, source address)
+    and TLS sessions
+    are resumed on new connections to the same server.
+    Requests to probed sites are made with `keep_alive` False: a DPI may
+    inspect only the first request of a connection, so every probe needs
+    a connection of its own.
+
+    HTTPS certificates are verified during the handshake of the connection
+    which is then used for the request, with the host name sent in SNI
+    even if connecting by IP.
+    """
+
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout=None, max_redirects=10):
+        self.timeout = timeout  # Chosen for every request by default, see _timeout()
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.contexts = {}
+        self.pool = {}
+        self.sessions = {}
+
+    def context(self, verify):
+        """Return a cached SSL context, with or without certificate check."""
+        with self.lock:
+            if verify not in self.contexts:
+                context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+                if not verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                self.contexts[verify] = context
+            return self.contexts[verify]
+
+    def _connect(self, key):
+        scheme, address, port, sni, proxy, verify, source = key
+        source_address = (source, 0) if source else None
+        if proxy:
+            proxy_host, _, proxy_port = proxy.rpartition(':')
+            connect_to = (proxy_host, int(proxy_port))
+        else:
+            connect_to = (address, port)
+
+        _HTTPConnection, _HTTPSConnection = _connection_classes()
+        if scheme != 'https':
+            return _HTTPConnection(*connect_to, source_address=source_address)
+
+        with self.lock:
+            session = self.sessions.get(key)
+        conn = _HTTPSConnection(*connect_to, server_hostname=sni, session=session,
+                                context=self.context(verify), source_address=source_address)
+        if proxy:
+            conn.set_tunnel(address, port)
+        return conn
+
+    def _acquire(self, key, keep_alive=True):
+        """Return a tuple of a connection for `key` and whether it was used before."""
+        if not keep_alive:
+            return self._connect(key), False
+        with self.lock:
+            idle = self.pool.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _release(self, key, conn, response, keep_alive=True):
+        if not keep_alive or not response.isclosed() or response.will_close or conn.sock is None:
+            conn.close()
+            return
+        with self.lock:
+            if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session:
+                self.sessions[key] = conn.sock.session
+            self.pool.setdefault(key, []).append(conn)
+
+    @staticmethod
+    def peer_certificate(sock, verified):
+        """
+        Return a dict describing the certificate of the server `sock`
+        is connected to: verification result, decoded certificate (only
+        if verified) and the chain as a list of DER-encoded certificates.
+        """
+        if hasattr(sock, 'get_verified_chain') and verified:
+            chain = list(sock.get_verified_chain())
+        else:
+            chain = [sock.getpeercert(binary_form=True)]
+        return {'verified': verified, 'cert': sock.getpeercert() if verified else None, 'chain': chain}
+
+    def _send(self, conn, selector, netloc, timeout=None):
+        """
+        Send GET request over `conn` and return the response and the socket.
+        The latter is returned since `conn` drops it when the server closes
+        the connection.
+        """
+        if conn.sock is None:
+            conn.timeout = timeout or self.timeout or _timeout('connect')
+            conn.connect()
+        sock = conn.sock
+        sock.settimeout(timeout or self.timeout or _timeout('http'))
+        with _span('ttfb', selector if selector.startswith('http') else netloc + selector):
+            conn.request('GET', selector, headers={'Host': netloc, 'User-Agent': SWUSERAGENT})
+            return conn.getresponse(), sock
+
+    def request(self, url, ip=None, proxy=None, follow_redirects=True, lookfor=None, verify=True, timeout=None,
+                keep_alive=True):
+        """
+        Make GET request to `url`, connecting to `ip` if given, and return
+        a tuple of status, headers, body bytes and peer certificate info
+        (see peer_certificate(), None for plain HTTP). Raise http.client,
+        ssl or socket exceptions on errors. `timeout` replaces the probe
+        timeouts of connecting and reading, see _timeout(). If `keep_alive`
+        is False, the connections are neither taken from the pool nor put there.
+
+        If `verify` is True, the certificate of the requested HTTPS server
+        is verified. Servers we are redirected to are not checked.
+        See _read_until() for `lookfor`.
+        """
+        certificate = None
+        for redirect in range(self.max_redirects + 1):
+            split = urllib.parse.urlsplit(url)
+            scheme = split.scheme.lower()
+            port = split.port or (443 if scheme == 'https' else 80)
+            verify_this = verify and redirect == 0 and scheme == 'https'
+            key = (scheme, ip or split.hostname, port, split.hostname if scheme == 'https' else None,
+                   proxy, verify_this, _run().source_address)
+            selector = urllib.parse.urlunsplit(('', '', split.path or '/', split.query, ''))
+            if proxy and scheme != 'https':
+                selector = url
+
+            conn, reused = self._acquire(key, keep_alive)
             try:
+                try:
+                    response, sock = self._send(conn, selector, split.netloc, timeout)
+                except (http.client.RemoteDisconnected, ConnectionError):
+                    if not reused:
+                        raise
+                    # Server closed idle keep-alive connection, use a new one
+                    conn.close()
+                    conn = self._connect(key)
+                    response, sock = self._send(conn, selector, split.netloc, timeout)
+
+                if redirect == 0 and scheme == 'https':
+                    certificate = self.peer_certificate(sock, verify_this)
+
+                location = response.getheader('Location')
+                if follow_redirects and response.status in self.REDIRECT_CODES and location \
+                        and redirect < self.max_redirects:
+                    response.read()
+                    self._release(key, conn, response, keep_alive)
+                    newurl = urllib.parse.urljoin(url, location)
+                    if urllib.parse.urlsplit(newurl).hostname != split.hostname:
+                        ip = None
+                    url = newurl
+                    continue
+
+                with _span('body', url):
+                    if lookfor:
+                        body = _read_until(response, lookfor, max_body_size)
+                    else:
+                        body = response.read()
+            except BaseException:
+                conn.close()
+                raise
+            self._release(key, conn, response, keep_alive)
+            return response.status, response.msg, body, certificate
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, {}
+        for connections in pool.values():
+            for conn in connections:
                 conn.close()
-            except Exception:
-                pass
 
-    # SSL Context for urllib
-    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-    # Disable SSL certificate check as we validated it earlier
-    # This is required to bypass SNI woes when we connect by IP
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
-
-    https_handler = urllib.request.HTTPSHandler(context=context)
-    if not follow_redirects:
-        # HACK: this works only for HTTP and conflicts with https_handler
-        opener = urllib.request.build_opener(NoRedirectHandler, https_handler)
-    else:
-        opener = urllib.request.build_opener(https_handler)
 
-    if ip:
-        parsed_url[1] = '[' + str(ip) + ']' if ':' in str(ip) else str(ip)
-        newurl = urllib.parse.urlunsplit(parsed_url)
-        req = urllib.request.Request(newurl)
-        req.add_header('Host', host)
-    else:
-        req = urllib.request.Request(url)
+http_client = HTTPClient()
 
-    if proxy:
-        req.set_proxy(proxy, 'http')
 
-    req.add_header('User-Agent', SWUSERAGENT)
+def _get_url(url, proxy=None, ip=None, headers=False, follow_redirects=True, lookfor=None,
+             certificate=False, keep_alive=True):
+    """
+    Fetch `url` and return a tuple of HTTP status and the page.
+    Status is 0 on connection errors and -1 if the certificate is invalid.
 
+    If `lookfor` is given, the body is read only until that marker
+    (or one of the markers if it is a tuple) or `max_body_size` bytes.
+
+    If `certificate` is True, the tuple has a third item: a dict with
+    the certificate verification result and chain, see
+    HTTPClient.peer_certificate(), or None if there was no TLS connection.
+
+    Probes of blocked sites pass `keep_alive` False, see HTTPClient.
+    """
+    def result(status, output, peer=None):
+        return (status, output, peer) if certificate else (status, output)
+
+    print_debug("_get_url: connecting over " + ('IPv6' if (':' in ip if ip else False) else 'IPv4'))
     try:
-        opened = opener.open(req, timeout=15)
-        output = opened.read()
+        status, response_headers, output, peer = http_client.request(url, ip=ip, proxy=proxy,
+                                                                     follow_redirects=follow_redirects,
+                                                                     lookfor=lookfor, keep_alive=keep_alive)
+        if status >= 400:
+            return result(status, '', peer)
         output = _decode_bytes(output)
         if (headers):
-            output = str(opened.headers) + output
-        opened.close()
+            output = str(response_headers) + output
     except (ssl.CertificateError) as e:
-        print_debug("_get_url: late ssl.CertificateError", repr(e))
-        return (-1, '')
-    except (urllib.error.URLError, ssl.SSLError, socket.error, socket.timeout) as e:
-        print_debug("_get_url: late socket exception", repr(e))
+        print_debug("_get_url: ssl.CertificateError", repr(e))
+        return result(-1, '', {'verified': False, 'error': str(e)})
+    except (http.client.HTTPException, ssl.SSLError, socket.error, socket.timeout) as e:
+        print_debug("_get_url: socket exception", repr(e))
         if 'CERTIFICATE_VERIFY_FAILED' in str(e):
-            return (-1, '')
-        if type(e) is urllib.error.HTTPError:
-            return (e.code, '')
-        return (0, '')
+            return result(-1, '', {'verified': False, 'error': str(e)})
+        return result(0, '')
     except (KeyboardInterrupt, SystemExit) as e:
         # re-raise exception to send it to caller function
         raise e
     except Exception as e:
         print("[☠] Неизвестная ошибка:", repr(e))
-        return (0, '')
-    return (opened.status, output)
+        return result(0, '')
+    return result(status, output, peer)
 
 
 def _cut_str(string, begin, end):
@@ -405,10 +1579,9 @@ def _cut_str(string, begin, end):
 def get_ip_and_isp():
     # Dirty and cheap
     try:
-        request = urllib.request.Request("https://2ip.ru/",
-                                         headers={"User-Agent": SWUSERAGENT}
-                                         )
-        data = _decode_bytes(urllib.request.urlopen(request, timeout=10).read())
+        status, data = _get_url("https://2ip.ru/")
+        if status != 200:
+            return
         ip = _cut_str(data, '<big id="d_clip_button">', '</big>')
         isp = ' '.join(_cut_str(data, '"/isp/', '</a>').replace('">', '').split())
         if ip and isp:
@@ -429,27 +1602,50 @@ def mask_ip(ipaddr):
     return None
 
 
-def _dpi_send(host, port, data, fragment_size=0, fragment_count=0):
-    sock = socket.create_connection((host, port), 10)
+def _dpi_send(host, port, data, fragment_size=0, fragment_count=0, lookfor=None):
+    """
+    Send raw `data` to host:port, first `fragment_count` pieces of
+    `fragment_size` bytes in separate packets, and return the reply.
+
+    If `lookfor` is given, stop reading as soon as both the status line
+    and `lookfor` have been received instead of waiting for the server
+    to close the connection.
+    """
+    marker = lookfor.encode() if lookfor else None
+    source_address = _run().source_address
+    with _span('connect', "{}:{}".format(host, port)):
+        sock = socket.create_connection((host, port), _timeout('connect'),
+                                        (source_address, 0) if source_address else None)
+    # Reading the reply waits for slow servers like HTTPClient does
+    sock.settimeout(_timeout('http'))
     if fragment_count:
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+    recv = bytearray()
     try:
-        for fragment in range(fragment_count):
-            sock.sendall(data[:fragment_size].encode())
-            data = data[fragment_size:]
-        sock.sendall(data.encode())
-        recvdata = sock.recv(8192)
-        recv = recvdata
-        while recvdata:
-            recvdata = sock.recv(8192)
-            recv += recvdata
+        with _span('exchange', "{}:{}".format(host, port)):
+            for fragment in range(fragment_count):
+                sock.sendall(data[:fragment_size].encode())
+                data = data[fragment_size:]
+            sock.sendall(data.encode())
+
+            chunk = bytearray(8192)
+            chunk_view = memoryview(chunk)
+            while True:
+                received = sock.recv_into(chunk)
+                if not received:
+                    break
+                # The marker may be split between two reads
+                search_from = max(0, len(recv) - len(marker) + 1) if marker else 0
+                recv += chunk_view[:received]
+                if marker and recv.find(marker, search_from) != -1 and recv.find(b"\n") != -1:
+                    break
     finally:
         try:
             sock.shutdown(socket.SHUT_RDWR)
         except Exception:
             pass
         sock.close()
-    return _decode_bytes(recv)
+    return _decode_bytes(bytes(recv))
 
 
 def _dpi_build_tests(host, urn, ip, lookfor):
@@ -596,7 +1792,7 @@ def check_isup(page_url):
     print("\tПроверяем доступность через {}".format(isup_server))
 
     url = isup_fmt.format(urllib.parse.urlparse(page_url).netloc)
-    status, output = _get_url(url)
+    status, output = _get_url(url, lookfor=('upicon', 'downicon'))
     # if output:
     #    output = json.loads(output)
 
@@ -622,69 +1818,235 @@ DNS_IPV6 = 1
 
 
 def test_dns(dnstype=DNS_IPV4):
+    started = time.monotonic()
     sites_list = list(dns_records_list)
     query_type = ("A" if dnstype == DNS_IPV4 else "AAAA")
+    third_party = third_party_dns if dnstype == DNS_IPV4 else third_party_dns_v6
 
     print("[O] Тестируем " + ("IPv4" if dnstype == DNS_IPV4 else "IPv6") + " DNS")
 
-    resolved_default_dns = _get_a_records(sites_list, query_type)
+    passes = {
+        'default': (sites_list, query_type, None, False),
+        'google_dns': (sites_list, query_type, (google_dns if dnstype == DNS_IPV4 else google_dns_v6), False),
+        'google_api': (sites_list, query_type, None, True),
+        'fake_dns': ((sites_list[0],), query_type, (fake_dns if dnstype == DNS_IPV4 else fake_dns_v6), False),
+    }
+    for server in third_party:
+        passes['dns_' + server] = (sites_list, query_type, server, False)
+    if dnstype == DNS_IPV4 and dns_dual_stack and _run().ipv6_available:
+        # Google API has no combined queries, get the records for the IPv6
+        # test into google_api_cache now. The system resolver gets them along with A.
+        passes['google_api_v6'] = (sites_list, 'AAAA', None, True)
+    # Other transports resolve all the names over one connection each
+    jobs = {'udp': (_get_a_records_many, (passes, None, True))}
+    for transport in dns_transports:
+        jobs[transport] = (_get_records_over_transport, (transport, sites_list, query_type))
+    done = _run_concurrently(jobs)
+    answers = done['udp']
+    answers.pop('google_api_v6', None)
+    for transport in dns_transports:
+        answers['google_' + transport] = done.get(transport, {})
+    resolved = {name: sorted(record for records in site_records.values() for record in records)
+                for name, site_records in answers.items()}
+    resolved_default_dns = resolved['default']
+    resolved_google_dns = resolved['google_dns']
+    resolved_google_api = resolved['google_api']
+    resolved_fake_dns = resolved['fake_dns']
+
     print("\tЧерез системный DNS:\t", str(resolved_default_dns))
-    resolved_google_dns = _get_a_records(sites_list, query_type, (google_dns if dnstype == DNS_IPV4 else google_dns_v6))
     if resolved_google_dns:
         print("\tЧерез Google DNS:\t", str(resolved_google_dns))
     else:
         print("\tНе удалось подключиться к Google DNS")
-    resolved_google_api = _get_a_records(sites_list, query_type, googleapi=True)
+    for server in third_party:
+        if resolved['dns_' + server]:
+            print("\tЧерез DNS {}:\t".format(server), str(resolved['dns_' + server]))
+        else:
+            print("\tНе удалось подключиться к DNS {}".format(server))
+    for transport, name in (('tcp', 'TCP'), ('tls', 'TLS'), ('https', 'HTTPS')):
+        if transport in dns_transports:
+            if resolved['google_' + transport]:
+                print("\tЧерез Google DNS по {}:\t".format(name), str(resolved['google_' + transport]))
+            else:
+                print("\tНе удалось получить адреса через Google DNS по {}".format(name))
+    # Google API and encrypted DNS can't be spoofed, their answers are the reference
+    reference = _merge_answers(answers.get(name, {}) for name in ('google_api', 'google_https', 'google_tls'))
     if resolved_google_api:
         print("\tЧерез Google API:\t", str(resolved_google_api))
     else:
         print("\tНе удалось подключиться к Google API")
-        really_bad_fuckup_happened()
-    resolved_fake_dns = _get_a_records((sites_list[0],), query_type, (fake_dns if dnstype == DNS_IPV4 else fake_dns_v6))
+        if reference:
+            print("\tАдреса для сравнения получены через Google DNS по HTTPS или TLS")
+        else:
+            really_bad_fuckup_happened()
     if resolved_fake_dns:
         print("\tЧерез недоступный DNS:\t", str(resolved_fake_dns))
     else:
         print("\tНесуществующий DNS не вернул адресов (это не ошибка)")
 
-    if not resolved_default_dns:
+    # The ISP may block or redirect only some of third-party DNS servers, so each one is compared on its own
+    third_party_answers = {'Google DNS': _merge_answers([answers['google_dns']])}
+    for server in third_party:
+        third_party_answers['DNS ' + server] = _merge_answers([answers['dns_' + server]])
+    third_party_answers = {name: site_answers for name, site_answers in third_party_answers.items() if site_answers}
+    verdict = _dns_verdict(answers['default'], third_party_answers, reference, resolved_fake_dns)
+    result = DnsResult("IPv4" if dnstype == DNS_IPV4 else "IPv6", verdict, resolved,
+                       time.monotonic() - started)
+    if dnstype == DNS_IPV4:
+        _run().results.dns_v4 = result
+    else:
+        _run().results.dns_v6 = result
+    return verdict
+
+
+def _merge_answers(answers_list):
+    """
+    Merge dicts of {site: records} into one with all the records of every
+    site. Sites without records are left out.
+    """
+    merged = {}
+    for answers in answers_list:
+        for site, records in answers.items():
+            if records:
+                merged[site] = sorted(set(merged.get(site, [])) | set(records))
+    return merged
+
+
+asn_cache = ResolverCache()
+
+
+def _ip_asn(ip):
+    """Return the autonomous system of a public IP address, None if unknown."""
+    try:
+        if not ipaddress.ip_address(ip).is_global:
+            return None
+    except ValueError:
+        return None
+    asns = asn_cache.get(('asn', ip), functools.partial(_fetch_asn, ip))
+    if not asns:
+        _run().asn_failures.add(ip)
+    return asns[0] if asns else None
+
+
+def _fetch_asn(ip):
+    """Look up the autonomous system of `ip` for asn_cache, failures are remembered by the run only."""
+    try:
+        asn = get_ispinfo(ip, _timeout('http'), _run().source_address)
+    except (OSError, ipwhois.exceptions.BaseIpwhoisException) as e:
+        print_debug("Can't get ASN of", ip, repr(e))
+        asn = None
+    return ([asn], asn_cache_ttl) if asn else ([], None)
+
+
+def _ip_asns(ips):
+    """
+    Return a dict of {ip: autonomous system} for `ips`, looked up at once
+    within one HTTP timeout. Addresses which failed earlier in the run,
+    or do not make it in time, are left out and not tried again.
+    """
+    run = _run()
+    ips = set(ips) - run.asn_failures
+    if not dns_consensus_asn or not ips:
+        return {}
+    asns = _run_concurrently({ip: (_ip_asn, (ip,)) for ip in ips}, _timeout('http'))
+    run.asn_failures.update(ips - set(asns))
+    return {ip: asn for ip, asn in asns.items() if asn}
+
+
+def _ip_network(ip):
+    """Return the network of `ip` of `dns_consensus_prefix` size."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    return ipaddress.ip_network((address, dns_consensus_prefix[address.version]), strict=False)
+
+
+def _records_close(records, other):
+    """Return True if two sets of records share an address or a network, empty ones are close only to each other."""
+    if not records or not other:
+        return records == other
+    if records & other:
+        return True
+    return bool({_ip_network(ip) for ip in records} & {_ip_network(ip) for ip in other})
+
+
+def _differing_records(answers, other):
+    """Return a list of pairs of records of the sites on which dicts of {site: records} are not close."""
+    pairs = [(set(answers.get(site, [])), set(other.get(site, []))) for site in set(answers) | set(other)]
+    return [(records, other_records) for records, other_records in pairs if not _records_close(records, other_records)]
+
+
+def _answers_agree(answers, other, asns):
+    """
+    Return True if dicts of {site: records} point to the same sites: for
+    every site the records share an address, a network or an autonomous
+    system (by `asns`, see _ip_asns()), as CDNs rotate addresses and answer
+    differently to different resolvers. Empty answers agree only with each other.
+    """
+    return all(records and other_records and
+               {asns.get(ip) for ip in records} & {asns.get(ip) for ip in other_records} - {None}
+               for records, other_records in _differing_records(answers, other))
+
+
+def _dns_verdict(default_answers, third_party_answers, reference_answers, resolved_fake_dns):
+    """
+    Return the DNS verdict code from the answers of the system DNS, the
+    reference ones (Google API and encrypted DNS), dicts of {site: records},
+    and third-party DNS servers which replied, a dict of {name: answers}.
+    """
+    if not any(default_answers.values()):
         print("[?] Ошибка получения адреса через системный DNS")
         really_bad_fuckup_happened()
         return 5
 
-    elif not resolved_google_dns:
+    elif not third_party_answers:
         print("[☠] Сторонние DNS блокируются")
         return 4
 
-    # Assume that Google API always works and returns correct addresses
-    dns_records = resolved_google_api
-
-    if not dns_records:
+    # Assume that Google API (or DNS over HTTPS or TLS if it failed) returns correct addresses
+    if not reference_answers:
         print("[?] Не удалось связаться с Google API. Проверка DNS сломана.")
         really_bad_fuckup_happened()
         return 5
 
-    if resolved_default_dns == resolved_google_dns:
-        if not resolved_fake_dns and len(resolved_default_dns) == len(dns_records):
+    # All the answers are compared at once, so the addresses are looked up in one round
+    comparisons = [(default_answers, reference_answers)]
+    for answers in third_party_answers.values():
+        comparisons += [(default_answers, answers), (answers, reference_answers)]
+    asns = _ip_asns(ip for answers, other in comparisons for records, other_records in _differing_records(answers, other)
+                    if records and other_records for ip in records | other_records)
+    # Third-party DNS servers which answer like the system DNS are redirected to it if it lies
+    like_default = {name: _answers_agree(default_answers, answers, asns)
+                    for name, answers in third_party_answers.items()}
+    like_reference = {name: _answers_agree(answers, reference_answers, asns)
+                      for name, answers in third_party_answers.items()}
+    for name in third_party_answers:
+        if not like_default[name]:
+            print("\t{} отвечает иначе, чем системный DNS".format(name))
+        if not like_reference[name]:
+            print("\tОтветы {} не совпадают с адресами для сравнения".format(name))
+
+    if _answers_agree(default_answers, reference_answers, asns):
+        if not resolved_fake_dns:
             print("[✓] DNS-записи не подменяются")
             print("[✓] DNS не перенаправляется")
             return 0
 
-        if resolved_default_dns == dns_records:
-            # Resolved DNS = Google DNS = Google API, and fake
-            # DNS resolved something.
-            print("[✓] DNS-записи не подменяются")
-            print("[☠] DNS перенаправляется")
-            return 1
-        else:
-            print("[☠] DNS-записи подменяются")
-            print("[☠] DNS перенаправляется")
-            return 2
+        # Resolved DNS = Google API, and fake DNS resolved something.
+        print("[✓] DNS-записи не подменяются")
+        print("[☠] DNS перенаправляется")
+        return 1
 
-    else:
-        if resolved_google_dns == dns_records:
-            print("[☠] DNS-записи подменяются")
-            print("[✓] DNS не перенаправляется")
-            return 3
+    if any(like_default.values()):
+        print("[☠] DNS-записи подменяются")
+        print("[☠] DNS перенаправляется")
+        return 2
+
+    if any(like_reference.values()):
+        print("[☠] DNS-записи подменяются")
+        print("[✓] DNS не перенаправляется")
+        return 3
 
     if resolved_fake_dns:
         # Resolved DNS != Google DNS != Google API, and fake DNS resolved something.
@@ -709,6 +2071,97 @@ HTTP_ISUP_ALLDOWN = 2
 HTTP_ISUP_BROKEN = 3
 
 
+@dataclasses.dataclass
+class HttpSiteResult:
+    """
+    Result of probing one site from `http_list`.
+
+    `ok_v6` is True if IPv6 was not checked. `proxy_ok` is None if
+    the site was not checked through proxy, `isup` is meaningful only if
+    `proxy_ok` is False.
+    """
+    site: str
+    status: int = 0
+    status_v6: int = 0
+    ok: bool = False
+    ok_v6: bool = True
+    proxy_status: int = None
+    proxy_ok: bool = None
+    isup: bool = None
+
+
+def _http_probe_site(site, params, by_ip):
+    """
+    Probe one site of `http_list` over IPv4, IPv6 and proxy and
+    return a HttpSiteResult.
+    """
+    ipv6_available = _run().ipv6_available
+    params = dict(params)
+    result = HttpSiteResult(site)
+    print("\tОткрываем ", site)
+    # First try to resolve IP address using Google API.
+    # Use a static one if this did not work.
+    if by_ip:
+        domain = list(urllib.parse.urlsplit(site))[1]
+        lookups = {'A': (_get_a_record_over_google_api, (domain, 'A'))}
+        if ipv6_available:
+            lookups['AAAA'] = (_get_a_record_over_google_api, (domain, 'AAAA'))
+        newips = _run_concurrently(lookups)
+
+        if newips.get('A'):
+            params['ip'] = newips['A'][0]
+        if ipv6_available and params.get('ipv6') and newips.get('AAAA'):
+            params['ipv6'] = newips['AAAA'][0]
+
+    fetch = functools.partial(_get_url, site, headers=True, lookfor=params['lookfor'],
+                              follow_redirects=params.get('follow_redirects', True), keep_alive=False)
+    if ipv6_available:
+        fetched = _run_concurrently({
+            4: (_captured, (fetch, None, params.get('ip'))),
+            6: (_captured, (fetch, None, params.get('ipv6'))),
+        })
+        response, output = fetched[4]
+        _replay(output)
+        response_v6, output = fetched[6]
+        _replay(output)
+    else:
+        response = fetch(ip=params.get('ip') if by_ip else None)
+        response_v6 = None
+
+    result.status = response[0]
+    result.ok = (response[0] == params['status'] and response[1].find(params['lookfor']) != -1)
+    if ipv6_available and params.get('ipv6'):
+        result.status_v6 = response_v6[0]
+        result.ok_v6 = (response_v6[0] == params['status'] and response_v6[1].find(params['lookfor']) != -1)
+
+    if result.ok and result.ok_v6:
+        print("[✓] Сайт открывается")
+    elif ipv6_available and (result.ok or result.ok_v6):
+        if not result.ok and result.ok_v6:
+            print("[!] Сайт открывается только по IPv6")
+        else:
+            print("[!] Сайт открывается только по IPv4")
+    if not (result.ok and result.ok_v6):
+        if (response[0] == params['status'] or (ipv6_available and response_v6[0] == params['status'])):
+            print("[☠] Получен неожиданный ответ, скорее всего, "
+                  "страница-заглушка провайдера. Пробуем через прокси.")
+        else:
+            print("[☠] Сайт не открывается, пробуем через прокси")
+        response_proxy = _get_url(site, _run().proxy or proxy_addr, lookfor=params['lookfor'], keep_alive=False)
+        result.proxy_status = response_proxy[0]
+        result.proxy_ok = (response_proxy[0] == params['status'] and response_proxy[1].find(params['lookfor']) != -1)
+        if result.proxy_ok:
+            print("[✓] Сайт открывается через прокси")
+        else:
+            if response_proxy[0] == params['status']:
+                print("[☠] Получен неожиданный ответ, скорее всего, "
+                      "страница-заглушка провайдера. Считаем заблокированным.")
+            else:
+                print("[☠] Сайт не открывается через прокси")
+            result.isup = check_isup(site)
+    return result
+
+
 def test_http_access(by_ip=False):
     """
     Test plain HTTP access and return three values:
@@ -716,9 +2169,12 @@ def test_http_access(by_ip=False):
     1. The result - one of the HTTP_ACCESS_* constants
     2. isup.me info - one of the HTTP_ISUP_* constants
     3. Subdomain block result
+
+    All sites are probed concurrently, the counters are reduced
+    from the per-site results afterwards.
     """
     sites = http_list
-    proxy = proxy_addr
+    ipv6_available = _run().ipv6_available
 
     print("[O] Тестируем HTTP" + (' (по настоящим IP-адресам сайтов)' if by_ip else ''))
 
@@ -733,79 +2189,42 @@ def test_http_access(by_ip=False):
     result_v4 = -1
     result_v6 = -1
 
-    for site in sorted(sites):
-        print("\tОткрываем ", site)
-        # First try to resolve IP address using Google API.
-        # Use a static one if this did not work.
-        if by_ip:
-            domain = list(urllib.parse.urlsplit(site))[1]
-            newip = _get_a_record_over_google_api(domain)
-            if ipv6_available:
-                newipv6 = _get_a_record_over_google_api(domain, 'AAAA')
-
-            if newip:
-                sites[site]['ip'] = newip[0]
-            if ipv6_available and sites[site].get('ipv6') and newipv6:
-                sites[site]['ipv6'] = '[' + newipv6[0] + ']'
-
-        if ipv6_available:
-            result = _get_url(site, ip=sites[site].get('ip'), headers=True,
-                              follow_redirects=sites[site].get('follow_redirects', True))
-            result_v6 = _get_url(site, ip=sites[site].get('ipv6'), headers=True,
-                                 follow_redirects=sites[site].get('follow_redirects', True))
-        else:
-            result = _get_url(site, ip=sites[site].get('ip') if by_ip else None,
-                              headers=True,
-                              follow_redirects=sites[site].get('follow_redirects', True))
-
-        result_ok = (result[0] == sites[site]['status'] and result[1].find(sites[site]['lookfor']) != -1)
-        if ipv6_available and sites[site].get('ipv6'):
-            result_v6_ok = (result_v6[0] == sites[site]['status'] and result_v6[1].find(sites[site]['lookfor']) != -1)
-        else:
-            result_v6_ok = True  # Not really
+    started = time.monotonic()
+    siteresults = []
+    probes = [(_http_probe_site, site, sites[site], by_ip) for site in sorted(sites)]
+    for siteresult, output in _imap_concurrently(_captured, probes):
+        _replay(output)
+        siteresults.append(siteresult)
 
-        if result_ok and result_v6_ok:
-            print("[✓] Сайт открывается")
+    for siteresult in siteresults:
+        params = sites[siteresult.site]
+        is_blacklisted = params.get('is_blacklisted', True)
 
-            if sites[site].get('is_blacklisted', True):
+        if siteresult.ok and siteresult.ok_v6:
+            if is_blacklisted:
                 successes_v4 += 1
                 successes_v6 += 1
-        elif ipv6_available and (result_ok or result_v6_ok):
-            if not result_ok and result_v6_ok:
-                print("[!] Сайт открывается только по IPv6")
+        elif ipv6_available and (siteresult.ok or siteresult.ok_v6):
+            if not siteresult.ok and siteresult.ok_v6:
                 successes_v6 += 1
             else:
-                print("[!] Сайт открывается только по IPv4")
                 successes_v4 += 1
-        if not (result_ok and result_v6_ok):
-            if (result[0] == sites[site]['status'] or (ipv6_available and result_v6[0] == sites[site]['status'])):
-                print("[☠] Получен неожиданный ответ, скорее всего, "
-                      "страница-заглушка провайдера. Пробуем через прокси.")
-            else:
-                print("[☠] Сайт не открывается, пробуем через прокси")
-            result_proxy = _get_url(site, proxy)
-            if result_proxy[0] == sites[site]['status'] and result_proxy[1].find(sites[site]['lookfor']) != -1:
-                print("[✓] Сайт открывается через прокси")
-                if sites[site].get('is_blacklisted', True):
-                    successes_proxy += 1
+
+        if siteresult.proxy_ok:
+            if is_blacklisted:
+                successes_proxy += 1
+        elif siteresult.proxy_ok is False:
+            if siteresult.isup is None:
+                if is_blacklisted:
+                    blocks_ambiguous += 1
+            elif siteresult.isup:
+                if params.get('subdomain'):
+                    blocks_subdomains += 1
+                if is_blacklisted:
+                    blocks += 1
             else:
-                if result_proxy[0] == sites[site]['status']:
-                    print("[☠] Получен неожиданный ответ, скорее всего, "
-                          "страница-заглушка провайдера. Считаем заблокированным.")
-                else:
-                    print("[☠] Сайт не открывается через прокси")
-                isup = check_isup(site)
-                if isup is None:
-                    if sites[site].get('is_blacklisted', True):
-                        blocks_ambiguous += 1
-                elif isup:
-                    if sites[site].get('subdomain'):
-                        blocks_subdomains += 1
-                    if sites[site].get('is_blacklisted', True):
-                        blocks += 1
-                else:
-                    if sites[site].get('is_blacklisted', True):
-                        down += 1
+                if is_blacklisted:
+                    down += 1
 
     all_sites = [http_list[i].get('is_blacklisted', True) for i in http_list].count(True)
 
@@ -839,6 +2258,8 @@ def test_http_access(by_ip=False):
     else:
         isup = HTTP_ISUP_ALLUP
 
+    _run().results.http = HttpResult(by_ip, result_v4, result_v6, isup, blocks_subdomains > 0, siteresults,
+                                     time.monotonic() - started)
     return result_v4, result_v6, isup, (blocks_subdomains > 0)
 
 
@@ -848,23 +2269,32 @@ def test_https_cert():
 
     print("[O] Тестируем HTTPS")
 
+    started = time.monotonic()
     siteresults = []
+    records = []
     for site in sorted(sites):
         print("\tОткрываем ", site)
         domain = list(urllib.parse.urlsplit(site))[1]
         newip = _get_a_record_over_google_api(domain)
         if newip:
             newip = newip[0]
-            result = _get_url(site, ip=newip, follow_redirects=False)
+            result = _get_url(site, ip=newip, follow_redirects=False, certificate=True, keep_alive=False)
         else:
             print_debug("Can't resolve IP for", site)
-            result = _get_url(site, follow_redirects=False)
+            result = _get_url(site, follow_redirects=False, certificate=True, keep_alive=False)
+        if result[2] and result[2].get('cert'):
+            print_debug("Certificate of", site, "issued to", result[2]['cert'].get('subject'),
+                        "by", result[2]['cert'].get('issuer'))
+        record = HttpsSiteResult(site, newip or None, result[0],
+                                 result[2].get('verified') if result[2] else None)
+        records.append(record)
         if result[0] == -1:
             print("[☠] Сертификат подменяется")
             siteresults.append(False)
         elif result[0] == 0:
             print("[☠] Сайт не открывается")
-            if check_isup(site):
+            record.isup = check_isup(site)
+            if record.isup:
                 siteresults.append('no')
             else:
                 isup_problems = True
@@ -873,60 +2303,144 @@ def test_https_cert():
             siteresults.append(True)
     if 'no' in siteresults:
         # Blocked
-        return 2
+        verdict = 2
     elif False in siteresults:
         # Wrong certificate
-        return 1
+        verdict = 1
     elif not isup_problems and all(siteresults):
         # No blocks
-        return 0
+        verdict = 0
     else:
         # Some sites are down or unknown result
-        return 3
+        verdict = 3
+    _run().results.https = HttpsResult(verdict, records, time.monotonic() - started)
+    return verdict
 
 
-def test_dpi():
-    global message_to_print
-    message_to_print = ""
-    print("[O] Тестируем обход DPI" + (' (только IPv4)' if ipv6_available else ''))
+DPI_RESULT_OK = 'ok'
+DPI_RESULT_PASSIVE = 'passive'
+DPI_RESULT_BLOCKED = 'blocked'
+DPI_RESULT_ERROR = 'error'
 
-    dpiresults = []
-    for dpisite in sorted(dpi_list):
-        site = dpi_list[dpisite]
-        # First try to resolve IP address using Google API.
-        # Use a static one if this did not work.
-        newip = _get_a_record_over_google_api(site['host'])
-        if newip:
-            site['ip'] = newip[0]
-        if ipv6_available:
-            newip = _get_a_record_over_google_api(site['host'], 'AAAA')
-            if newip:
-                site['ipv6'] = newip[0]
 
-        dpi_built_tests = _dpi_build_tests(site['host'], site['urn'], site['ip'], site['lookfor'])
-        for testname in sorted(dpi_built_tests):
-            test = dpi_built_tests[testname]
-            print("\tПробуем способ «{}» на {}".format(testname, dpisite))
-            try:
-                result = _dpi_send(test.get('ip'), 80, test.get('data'), test.get('fragment_size'),
-                                   test.get('fragment_count'))
-            except (KeyboardInterrupt, SystemExit) as e:
-                # re-raise exception to send it to caller function
-                raise e
-            except Exception as e:
-                print("[☠] Ошибка:", repr(e))
-            else:
-                if result.split("\n")[0].find('200 ') != -1 and result.find(test['lookfor']) != -1:
+def _dpi_check_technique(test, limit):
+    """
+    Try one DPI bypass technique and return a tuple of one of DPI_RESULT_*
+    constants and an error description. `limit` is a semaphore bounding the
+    number of simultaneous connections to the target IP.
+    """
+    with limit:
+        try:
+            result = _dpi_send(test.get('ip'), test.get('port', 80), test.get('data'), test.get('fragment_size'),
+                               test.get('fragment_count'), test.get('lookfor'))
+        except (KeyboardInterrupt, SystemExit) as e:
+            # re-raise exception to send it to caller function
+            raise e
+        except Exception as e:
+            return DPI_RESULT_ERROR, repr(e)
+
+    if result.split("\n")[0].find('200 ') != -1 and result.find(test['lookfor']) != -1:
+        return DPI_RESULT_OK, None
+    elif result.split("\n")[0].find('200 ') == -1 and result.find(test['lookfor']) != -1:
+        return DPI_RESULT_PASSIVE, None
+    return DPI_RESULT_BLOCKED, None
+
+
+def _dpi_run_matrix(cells, concurrency=None):
+    """
+    Run DPI bypass techniques concurrently, at most `concurrency`
+    (`dpi_concurrency` by default) at a time for every target IP.
+
+    `cells` is a dict of {(site name, technique name): test} as built by
+    _dpi_build_tests(). Progress is printed as each cell finishes.
+    Return a dict of {(site name, technique name): DPI_RESULT_*}.
+    """
+    concurrency = concurrency or dpi_concurrency
+    limits = {test.get('ip'): threading.BoundedSemaphore(concurrency) for test in cells.values()}
+    table = {}
+    if not cells:
+        return table
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(cells), concurrency * len(limits), max_threads))
+    try:
+        futures = {_submit(executor, _dpi_check_technique, test, limits[test.get('ip')]): cell
+                   for cell, test in sorted(cells.items())}
+        for future in concurrent.futures.as_completed(futures):
+            dpisite, testname = futures[future]
+            outcome, error = future.result()
+            table[(dpisite, testname)] = outcome
+            with print_lock:
+                print("\tПробуем способ «{}» на {}".format(testname, dpisite))
+                if outcome == DPI_RESULT_OK:
                     print("[✓] Сайт открывается")
-                    dpiresults.append(testname)
-                elif result.split("\n")[0].find('200 ') == -1 and result.find(test['lookfor']) != -1:
+                elif outcome == DPI_RESULT_PASSIVE:
                     print("[!] Сайт не открывается, обнаружен пассивный DPI!")
-                    dpiresults.append('Passive DPI')
+                elif outcome == DPI_RESULT_ERROR:
+                    print("[☠] Ошибка:", error)
                 else:
                     print("[☠] Сайт не открывается")
+    finally:
+        executor.shutdown(wait=False)
+    return table
+
+
+def test_dpi():
+    run = _run()
+    run.message_to_print.clear()
+    started = time.monotonic()
+    print("[O] Тестируем обход DPI" + (' (только IPv4)' if run.ipv6_available else ''))
+
+    # First try to resolve IP addresses using Google API.
+    # Use static ones if this did not work.
+    lookups = {}
+    for dpisite in dpi_list:
+        lookups[(dpisite, 'ip')] = (_get_a_record_over_google_api, (dpi_list[dpisite]['host'], 'A'))
+        if run.ipv6_available:
+            lookups[(dpisite, 'ipv6')] = (_get_a_record_over_google_api, (dpi_list[dpisite]['host'], 'AAAA'))
+    sites = {dpisite: dict(dpi_list[dpisite]) for dpisite in dpi_list}
+    for (dpisite, field), newip in _run_concurrently(lookups).items():
+        if newip:
+            sites[dpisite][field] = newip[0]
+
+    cells = {}
+    for dpisite in sorted(sites):
+        site = sites[dpisite]
+        dpi_built_tests = _dpi_build_tests(site['host'], site['urn'], site['ip'], site['lookfor'])
+        for testname in dpi_built_tests:
+            cells[(dpisite, testname)] = dict(dpi_built_tests[testname], port=site.get('port', 80))
+
+    run.dpi_result_table = _dpi_run_matrix(cells)
+
+    dpiresults = []
+    for (dpisite, testname), outcome in sorted(run.dpi_result_table.items()):
+        if outcome == DPI_RESULT_OK:
+            dpiresults.append(testname)
+        elif outcome == DPI_RESULT_PASSIVE:
+            dpiresults.append('Passive DPI')
+    run.results.dpi = DpiResult([{'site': dpisite, 'technique': testname, 'outcome': outcome}
+                                 for (dpisite, testname), outcome in sorted(run.dpi_result_table.items())],
+                                sorted(set(dpiresults)), time.monotonic() - started)
     if web_interface:
-        return message_to_print
-    return list(set(dpiresults))
+        return run.message_to_print.getvalue()
+    return sorted(set(dpiresults))
+
+
+def measure_rtt():
+    """Return the time to connect to `rtt_probe_addr` in seconds or None if it failed."""
+    source_address = _run().source_address
+    started = time.monotonic()
+    try:
+        with _span('connect', "{}:{}".format(*rtt_probe_addr)):
+            sock = socket.create_connection(rtt_probe_addr, _timeout('connect'),
+                                            (source_address, 0) if source_address else None)
+    except OSError as e:
+        print_debug("Can't measure RTT:", repr(e))
+        return None
+    rtt = time.monotonic() - started
+    sock.close()
+    print_debug("RTT to {}:{} is {:.3f} s".format(rtt_probe_addr[0], rtt_probe_addr[1], rtt))
+    return rtt
 
 
 def check_ipv6_availability():
@@ -947,9 +2461,9 @@ def check_ipv6_availability():
     return False
 
 
-def get_ispinfo(ipaddr):
+def get_ispinfo(ipaddr, timeout=5, source_address=None):
     try:
-        rdap_response = ipwhois.IPWhois(ipaddr)
+        rdap_response = ipwhois.IPWhois(ipaddr, timeout, _source_opener(source_address) if source_address else None)
         ispinfo = rdap_response.lookup_rdap(depth=1)
         return ispinfo['asn']
     except (ipwhois.exceptions.ASNRegistryError,
@@ -960,9 +2474,258 @@ def get_ispinfo(ipaddr):
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def _source_opener(source_address):
+    """Return urllib opener which connects from `source_address`, e.g. for RDAP lookups of ipwhois."""
+
+    class SourceHTTPHandler(urllib_request.HTTPHandler):
+        def http_open(self, req):
+            return self.do_open(functools.partial(http.client.HTTPConnection,
+                                                  source_address=(source_address, 0)), req)
+
+    class SourceHTTPSHandler(urllib_request.HTTPSHandler):
+        def https_open(self, req):
+            return self.do_open(functools.partial(http.client.HTTPSConnection,
+                                                  source_address=(source_address, 0)), req, context=self._context)
+
+    return urllib_request.build_opener(SourceHTTPHandler, SourceHTTPSHandler)
+
+
+def run_tests(stages=STAGES, cached=None):
+    """
+    Run the test `stages` (a subset of STAGES) in the current run and
+    return a dict of their results. Results of the stages which were not
+    run are None. A 'stage' event with the name of the stage and a copy of
+    the results so far is emitted to the run subscribers after every stage.
+
+    Every stage starts as soon as the stages it depends on (see
+    STAGE_DEPENDENCIES) are done, so independent ones run concurrently.
+    Their output is shown one stage after another, in the order they
+    started: the first running stage prints as it goes, the output of the
+    others is held until the stages before them are done.
+
+    Stages found in `cached` (a dict of RunContext.stage_results of an
+    earlier run) are not run, their results are taken from there.
+    """
+    run = _run()
+    cached = cached or {}
+    results = dict.fromkeys(('dns_v4', 'dns_v6', 'http_v4', 'http_v6', 'http_isup',
+                             'subdomain_blocked', 'https', 'dpi'))
+
+    def run_dns():
+        with _span('stage', 'dns_v4'):
+            results['dns_v4'] = test_dns(DNS_IPV4)
+        run.settle_ipv6()
+        results['dns_v6'] = 0
+        if run.ipv6_available:
+            print()
+            with _span('stage', 'dns_v6'):
+                results['dns_v6'] = test_dns(DNS_IPV6)
+
+    def run_http():
+        run.settle_ipv6()
+        with _span('stage', 'http'):
+            (results['http_v4'], results['http_v6'],
+             results['http_isup'], results['subdomain_blocked']) = test_http_access(
+                bool(results['dns_v4']) or bool(results['dns_v6']))
+
+    def run_https():
+        with _span('stage', 'https'):
+            results['https'] = test_https_cert()
+
+    def run_dpi():
+        run.settle_ipv6()
+        results['dpi'] = '-'
+        if 'http' not in stages or results['http_v4'] > 0 or results['http_v6'] > 0 or force_dpi_check:
+            with _span('stage', 'dpi'):
+                results['dpi'] = test_dpi()
+
+    stage_functions = {'dns': run_dns, 'http': run_http, 'https': run_https, 'dpi': run_dpi}
+
+    def stage_deadline(stage):
+        """
+        Return the deadline of `stage`: its share of the time left, by
+        STAGE_WEIGHTS among it and the waiting stages which depend on it.
+        """
+        if run.deadline is None:
+            return None
+        chain = {stage}
+        for other in waiting:  # In the order of STAGES, so dependencies come first
+            if chain.intersection(STAGE_DEPENDENCIES[other]):
+                chain.add(other)
+        now = time.monotonic()
+        return now + max(run.deadline - now, 0) * STAGE_WEIGHTS[stage] / sum(STAGE_WEIGHTS[s] for s in chain)
+
+    def run_stage(deadline, stage_function):
+        _stage_deadline.set(deadline)
+        return stage_function()
+
+    def stage_done(stage):
+        run.stage_results[stage] = {
+            'results': {key: results[key] for key in STAGE_RESULTS[stage]},
+            'fields': {field: getattr(run.results, field) for field in STAGE_FIELDS[stage]},
+        }
+        run.emit('stage', {'stage': stage, 'results': dict(results)})
+
+    def from_cache(stage):
+        if stage not in cached:
+            return False
+        results.update(cached[stage]['results'])
+        for field, value in cached[stage]['fields'].items():
+            setattr(run.results, field, value)
+        print("[O] Результаты этапа {} взяты из кэша".format(stage))
+        run.emit('stage', {'stage': stage, 'results': dict(results)})
+        return True
+
+    def show_output():
+        """Pass on the output of the stages in `shown` up to the first one which is still running."""
+        with print_lock:
+            while shown:
+                capture = captures[shown[0]]
+                if not capture.live:
+                    lines, capture.lines = capture.lines, []
+                    capture.live = True
+                    capture.printed = any(not debug_only for debug_only, this_text in lines)
+                    _replay(lines)
+                if shown[0] not in done:
+                    return
+                shown.pop(0)
+                if capture.printed:
+                    print()
+
+    waiting = [stage for stage in STAGES if stage in stages]
+    running = {}
+    done = set()
+    captures = {}
+    shown = []  # Stages which output is not shown completely yet, in the order they started
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(waiting) or 1)
+    try:
+        while waiting or running:
+            for stage in list(waiting):
+                if all(dependency in done or dependency not in stages
+                       for dependency in STAGE_DEPENDENCIES[stage]):
+                    waiting.remove(stage)
+                    captures[stage] = _Capture(_output_capture.get())
+                    shown.append(stage)
+                    if _collecting(captures[stage], from_cache, stage):
+                        done.add(stage)
+                    else:
+                        running[_submit(executor, _collecting, captures[stage], run_stage,
+                                        stage_deadline(stage), stage_functions[stage])] = stage
+                    show_output()
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                future.result()
+                done.add(stage)
+                show_output()
+                stage_done(stage)
+    finally:
+        executor.shutdown(wait=False)
+
+    if timings_enabled:
+        run.results.timings = list(run.timings.spans)
+    return results
+
+
+def print_timings(timings):
+    """Print the time breakdown of a run: stages, then totals of every kind of probe."""
+    print("[O] Время выполнения:")
+    for span in timings.spans:
+        if span['kind'] in ('stage', 'preflight'):
+            print("\t{:<24} {:8.3f} с".format(span['label'], span['duration']))
+    print("\t{:<12} {:>6} {:>10} {:>10}".format('', 'кол-во', 'всего, с', 'макс., с'))
+    for kind, (count, total, longest) in sorted(timings.summary().items()):
+        if kind not in ('stage', 'preflight'):
+            print("\t{:<12} {:>6} {:>10.3f} {:>10.3f}".format(kind, count, total, longest))
+
+
+def run_vantage(vantage, run=None, cached=None):
+    """
+    Run the tests from one vantage point and return its RunResult.
+    The tests run in `run` if it is given (vantage keys except 'ipv6' are
+    then ignored), otherwise in a new quiet RunContext.
+    `vantage` is a dict with optional keys:
+
+        name:           name of the vantage point in the results
+        source_address: local address to send all probes from
+        resolver:       DNS server or list of servers used instead of the system ones
+        proxy:          HTTP proxy used instead of `proxy_addr`
+        stages:         list of stages to run, see STAGES
+        ipv6:           True or False to skip IPv6 availability check
+        max_runtime:    seconds the run may take, `max_runtime` by default
+
+    `cached` is passed to run_tests().
+    """
+    if run is None:
+        resolver = vantage.get('resolver')
+        run = RunContext(name=vantage.get('name'), source_address=vantage.get('source_address'),
+                         resolver=[resolver] if isinstance(resolver, str) else resolver,
+                         proxy=vantage.get('proxy'), stages=tuple(vantage.get('stages', STAGES)),
+                         quiet=True)
+    _current_run.set(run)
+    run.set_deadline(vantage.get('max_runtime', max_runtime))
+
+    try:
+        run.rtt = run.results.rtt = measure_rtt()
+        if disable_ipv6:
+            run.ipv6_available = False
+        elif 'ipv6' in vantage:
+            run.ipv6_available = bool(vantage['ipv6'])
+        else:
+            run.ipv6_available = check_ipv6_availability()
+        run_tests(run.stages, cached)
+    except Exception as e:
+        run.results.error = repr(e)
+    run.results.ipv6_available = bool(run.ipv6_available)
+    run.results.really_bad_fuckup = run.really_bad_fuckup
+    run.emit('done')
+    return run.results
+
+
+def run_batch(vantages, output=None):
+    """
+    Run the tests from all `vantages` (see run_vantage()) concurrently,
+    sharing caches and connection pools, and write one JSON line per
+    vantage point to `output` (stdout by default) as soon as it finishes.
+    """
+    output = output or sys.stdout
+    if dns_cache_file:
+        google_api_cache.load(dns_cache_file)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(vantages), max_threads) or 1)
+    try:
+        futures = [executor.submit(contextvars.Context().run, run_vantage, vantage) for vantage in vantages]
+        for future in concurrent.futures.as_completed(futures):
+            with print_lock:
+                output.write(to_ndjson([future.result()]))
+                output.flush()
+    finally:
+        executor.shutdown(wait=True)
+
+    if dns_cache_file:
+        google_api_cache.save(dns_cache_file)
+
+
+def _preflight(label, func, *args):
+    """Run a preflight check of main() with collecting its output, see _captured()."""
+    with _span('preflight', label):
+        return _captured(func, *args)
+
+
+def _ipv6_tunneled(ipv4_addr, ipv6_addr):
+    """Return True if IPv4 and IPv6 addresses belong to different ASes, what means IPv6 tunnel most likely."""
+    asns = _run_concurrently({4: (get_ispinfo, (ipv4_addr,)), 6: (get_ispinfo, (ipv6_addr,))})
+    return bool(asns[4] and asns[6] and asns[4] != asns[6])
+
+
 def main():
     ipv6_addr = None
-    global ipv6_available
+    run = _run()
+    run.reset_logs()
+    run.set_deadline(max_runtime)
 
     print("BlockCheck v{}".format(VERSION))
     print("Для получения корректных результатов используйте DNS-сервер",
@@ -970,43 +2733,60 @@ def main():
     print()
 
     if web_interface:
-        return message_to_print
-
-    latest_version = _get_url("https://raw.githubusercontent.com/ValdikSS/blockcheck/master/latest_version.txt")
+        return run.message_to_print.getvalue()
+
+    if dns_cache_file:
+        google_api_cache.load(dns_cache_file)
+
+    # Preflight checks run concurrently, their output is printed in the usual order
+    preflight = {
+        'version': (_preflight, ('version', _get_url,
+                                 "https://raw.githubusercontent.com/ValdikSS/blockcheck/master/latest_version.txt")),
+        'ip_isp': (_preflight, ('ip_isp', get_ip_and_isp)),
+        'rtt': (_preflight, ('rtt', measure_rtt)),
+    }
+    if not disable_ipv6:
+        preflight['ipv6'] = (_preflight, ('ipv6', check_ipv6_availability))
+    preflight = _run_concurrently(preflight)
+
+    run.rtt, lines = preflight['rtt']
+    run.results.rtt = run.rtt
+    _replay(lines)
+    latest_version, lines = preflight['version']
+    _replay(lines)
     if latest_version[0] == 200 and latest_version[1].strip() != VERSION:
         print("Доступная новая версия программы: {}. Обновитесь, пожалуйста.".format(latest_version[1].strip()))
         print()
     if not disable_ipv6:
-        ipv6_available = check_ipv6_availability()
-        if (ipv6_available):
-            ipv6_addr = ipv6_available
-    ip_isp = get_ip_and_isp()
+        run.ipv6_available, lines = preflight['ipv6']
+        _replay(lines)
+        if (run.ipv6_available):
+            ipv6_addr = run.ipv6_available
+    ip_isp, lines = preflight['ip_isp']
+    _replay(lines)
     if ip_isp:
-        if ipv6_available:
+        if run.ipv6_available:
             print("IP: {}, IPv6: {}, провайдер: {}".format(mask_ip(ip_isp[0]), mask_ip(ipv6_addr), ip_isp[1]))
             if not force_ipv6:
-                asn4 = get_ispinfo(ip_isp[0])
-                asn6 = get_ispinfo(ipv6_addr)
-                if asn4 and asn6 and asn4 != asn6:
-                    ipv6_available = False
-                    print("Вероятно, у вас IPv6-туннель. Проверка IPv6 отключена.")
+                # RDAP is slow, IPv4 DNS test does not need its outcome and runs meanwhile
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                run.ipv6_pending = _submit(executor, _preflight, 'rdap', _ipv6_tunneled, ip_isp[0], ipv6_addr)
+                executor.shutdown(wait=False)
         else:
             print("IP: {}, провайдер: {}".format(mask_ip(ip_isp[0]), ip_isp[1]))
         print()
-    dnsv4 = test_dns(DNS_IPV4)
-    dnsv6 = 0
-    if ipv6_available:
-        print()
-        dnsv6 = test_dns(DNS_IPV6)
-    print()
-    http_v4, http_v6, http_isup, subdomain_blocked = test_http_access((dnsv4 != 0) or (dnsv6 != 0))
-    print()
-    https = test_https_cert()
-    print()
-    dpi = '-'
-    if http_v4 > 0 or http_v6 > 0 or force_dpi_check:
-        dpi = test_dpi()
-        print()
+
+    results = run_tests()
+    run.results.ipv6_available = bool(run.ipv6_available)
+    run.results.really_bad_fuckup = run.really_bad_fuckup
+    dnsv4, dnsv6 = results['dns_v4'], results['dns_v6']
+    http_v4, http_v6 = results['http_v4'], results['http_v6']
+    http_isup, subdomain_blocked = results['http_isup'], results['subdomain_blocked']
+    https = results['https']
+    ipv6_available = run.ipv6_available
+
+    if dns_cache_file:
+        google_api_cache.save(dns_cache_file)
     print("[!] Результат:")
     if dnsv4 == 5:
         print("[⚠] Не удалось определить способ блокировки IPv4 DNS.\n",
@@ -1129,16 +2909,16 @@ def main():
 
     if not disable_report:
         try:
-            report_request = urllib.request.urlopen(
+            report_request = urllib_request.urlopen(
                 'http://blockcheck.antizapret.prostovpn.org/postdata.php',
                 data=urllib.parse.urlencode({
-                    "text": printed_text,
-                    "text_debug": printed_text_with_debug if really_bad_fuckup else '',
+                    "text": run.printed_text.getvalue(),
+                    "text_debug": run.printed_text_with_debug.getvalue() if run.really_bad_fuckup else '',
                 }).encode('utf-8')
             )
             if (report_request):
                 report_request.close()
-        except urllib.error.URLError as e:
+        except urllib_request.URLError as e:
             # keep it silent
             pass
 
@@ -1156,8 +2936,26 @@ def main():
                               "https://github.com/ValdikSS/blockcheck/wiki/Нужна-ваша-помощь"
                               )
 
+    if timings_enabled:
+        print()
+        print_timings(run.timings)
+
+
+def print_startup_profile():
+    """
+    Print to stderr how long it took to import modules, to load this one
+    and to import every lazily imported module when it was first needed.
+    """
+    builtins.print("Время запуска:", file=sys.stderr)
+    builtins.print("\t{:<24} {:8.3f} с".format('импорт модулей', _imports_done - _load_started), file=sys.stderr)
+    builtins.print("\t{:<24} {:8.3f} с".format('загрузка blockcheck', _loaded - _imports_done), file=sys.stderr)
+    for name, since, spent in _lazy_imports:
+        builtins.print("\t{:<24} {:8.3f} с (на {:.3f} с после запуска)".format(name, spent, since),
+                       file=sys.stderr)
+
 
 def setup_args():
+    global dpi_concurrency
     if getattr(sys, 'frozen', False):
         os.environ['SSL_CERT_FILE'] = os.path.join(sys._MEIPASS, 'lib', 'ca-certificates.crt')
 
@@ -1170,10 +2968,26 @@ def setup_args():
                         .format(isup_server))
     parser.add_argument('--force-dpi-check', action='store_true',
                         help='Выполнить проверку DPI, даже если провайдер не блокирует сайты.')
+    parser.add_argument('--dpi-concurrency', type=int, default=dpi_concurrency,
+                        help='Количество одновременных попыток обхода DPI на один IP-адрес (по умолчанию {}).' \
+                        .format(dpi_concurrency))
+    parser.add_argument('--dns-cache', metavar='FILE',
+                        help='Сохранять ответы Google API в файл и использовать их при следующих запусках.')
     parser.add_argument('--disable-ipv6', action='store_true', help='Отключить поддержку IPv6.')
     parser.add_argument('--force-ipv6', action='store_true', help='Игнорировать обнаружение туннелей.')
     parser.add_argument('--debug', action='store_true', help='Включить режим отладки (и --no-report).')
     parser.add_argument('--web', action='store_true', help='Веб-интерфейс.')
+    parser.add_argument('--timings', action='store_true',
+                        help='Показать, сколько времени заняли этапы и отдельные проверки.')
+    parser.add_argument('--json', action='store_true',
+                        help='Вывести результаты в формате JSON вместо текста (включает --console).')
+    parser.add_argument('--max-runtime', type=float, metavar='SECONDS',
+                        help='Ограничить общее время проверки, сократив время ожидания ответов.')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Показать, сколько времени заняли импорт модулей и запуск программы.')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='Пакетный режим: выполнить проверку с нескольких точек, описанных в JSON-файле, '
+                             'и вывести результаты в формате JSON, по строке на точку.')
     args = parser.parse_args()
 
     if args.console:
@@ -1192,6 +3006,13 @@ def setup_args():
         global force_dpi_check
         force_dpi_check = True
 
+    if args.dpi_concurrency > 0:
+        dpi_concurrency = args.dpi_concurrency
+
+    if args.dns_cache:
+        global dns_cache_file
+        dns_cache_file = args.dns_cache
+
     if args.disable_ipv6:
         global disable_ipv6
         disable_ipv6 = True
@@ -1209,9 +3030,35 @@ def setup_args():
         global web_interface
         web_interface = True
 
+    if args.timings:
+        global timings_enabled
+        timings_enabled = True
+
+    if args.json:
+        global json_output
+        json_output = True
+        tkusable = False
+        default_run.quiet = True
+
+    if args.max_runtime:
+        global max_runtime
+        max_runtime = args.max_runtime
+
+    if args.startup_profile:
+        global startup_profile
+        startup_profile = True
+
+    if args.batch:
+        global batch_file
+        batch_file = args.batch
+        tkusable = False
+        disable_report = True
+
     return 0
 
 
+_loaded = time.perf_counter()
+
 if __name__ == "__main__":
     # if getattr(sys, 'frozen', False):
     #     os.environ['SSL_CERT_FILE'] = os.path.join(sys._MEIPASS, 'lib', 'ca-certificates.crt')
@@ -1256,11 +3103,19 @@ if __name__ == "__main__":
 
     setup_args()
 
-    if tkusable:
+    if batch_file:
+        with open(batch_file, encoding='utf-8') as vantages:
+            try:
+                run_batch(json.load(vantages))
+            except (KeyboardInterrupt, SystemExit):
+                os._exit(1)
+        if startup_profile:
+            print_startup_profile()
+    elif tkusable:
         root = tk.Tk()
         root.title("BlockCheck")
         root.protocol("WM_DELETE_WINDOW", tk_terminate)
-        text = ThreadSafeConsole(root, wrap=tk.WORD)
+        text = _thread_safe_console()(root, wrap=tk.WORD)
         text.pack(expand=1, fill='both')
         threading.Thread(target=main).start()
         try:
@@ -1273,3 +3128,7 @@ if __name__ == "__main__":
             main()
         except (KeyboardInterrupt, SystemExit):
             sys.exit(1)
+        if json_output:
+            builtins.print(default_run.results.to_json())
+        if startup_profile:
+            print_startup_profile()
@@ -27,7 +27,10 @@ a = Analysis(['blockcheck.py'],
              pathex=[],
              binaries=[],
              datas=add_datas,
-             hiddenimports=[],
+             # Imported lazily by blockcheck.py, invisible to the analysis
+             hiddenimports=['dns.resolver', 'dns.entropy', 'dns.exception', 'dns.flags', 'dns.inet', 'dns.message',
+                            'dns.query', 'dns.rcode', 'http.client', 'ipwhois', 'ssl', 'tkinter', 'tkinter.scrolledtext',
+                            'urllib.request'],
              hookspath=hooks_p,
              runtime_hooks=hooks_r,
              excludes=[],
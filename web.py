@@ -1,51 +1,235 @@
-from flask import Flask, render_template, request, json
+from flask import Flask, Response, render_template, request, json, g, stream_with_context
+import collections
+import concurrent.futures
+import functools
+import contextvars
+import hmac
+import os
+import queue
 import sys
+import threading
+import time
+import uuid
 
 import blockcheck
 
+MAX_JOBS = 8  # Checks running at the same time, others wait in a queue
+JOB_TTL = 3600  # Seconds to keep results of finished checks
+SESSION_TTL = 1800  # Seconds to keep state of visitors who stopped making requests
+SESSION_COOKIE = 'blockcheck_session'
+RESULT_CACHE_TTL = 300  # Seconds to reuse stage results for checks from the same network, DNS and IP family
+EGRESS_ASN_TTL = 60  # Seconds to reuse the ASN of the outgoing address of the server
+KEEPALIVE_INTERVAL = 15  # Seconds between comments sent to an idle event stream
+ADMIN_TOKEN = os.environ.get('BLOCKCHECK_ADMIN_TOKEN')  # Bearer token for DELETE /cache, disabled if not set
+
 app = Flask(__name__)
-dnsv4 = 0
-dnsv6 = 0
-http_v4 = 0
-http_v6 = 0
-https = 0
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_JOBS)
+jobs = {}
+jobs_lock = threading.Lock()
+sessions = {}
+sessions_lock = threading.Lock()
 
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+class ResultCache():
+    """
+    Recent stage results keyed by (ASN, DNS servers, IP family).
 
+    The checks run from the server, so ones from the same network with the
+    same DNS servers get the same verdicts. A check reuses the stages which
+    were checked not long ago and runs only the rest.
+    """
 
-@app.route('/about')
-def about():
-    return render_template('about.html')
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # {key: {stage: (expires, RunContext.stage_results item)}}
+        self.stats = collections.Counter()
 
+    def get(self, key, stages):
+        """Return the still valid results of `stages` for `key`, see blockcheck.run_tests()."""
+        now = time.monotonic()
+        with self.lock:
+            found = {stage: result for stage, (expires, result) in self.entries.get(key, {}).items()
+                     if stage in stages and expires > now}
+            if len(found) == len(stages):
+                self.stats['hits'] += 1
+            elif found:
+                self.stats['partial_hits'] += 1
+            else:
+                self.stats['misses'] += 1
+        return found
 
-@app.route('/start', methods=['GET'])
-def button_clicked():
-    print("BUTTON CLICK!")
-    blockcheck.main()
-    msg = "Для получения корректных результатов используйте DNS-сервер провайдера и отключите средства обхода блокировок."
-    return json.dumps({'msg': msg})
+    def put(self, key, stage_results):
+        now = time.monotonic()
+        with self.lock:
+            for old_key in [old_key for old_key, entry in self.entries.items()
+                            if all(expires <= now for expires, result in entry.values())]:
+                del self.entries[old_key]
+            entry = self.entries.setdefault(key, {})
+            for stage, result in stage_results.items():
+                entry[stage] = (now + self.ttl, result)
 
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
 
-@app.route('/get-ip', methods=['GET'])
-def get_ip_and_isp():
+    def invalidate(self, asn=None):
+        """Drop the results of `asn` or all of them, return the number of dropped keys."""
+        with self.lock:
+            keys = [key for key in self.entries if asn is None or str(key[0]) == str(asn)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'ttl': self.ttl,
+                'entries': len(self.entries),
+                'stats': dict(self.stats),
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_TTL)
+egress_asn_cache = blockcheck.ResolverCache()
+
+
+def _fetch_egress_asn():
     ip_isp = blockcheck.get_ip_and_isp()
-    msg = ''
-    if ip_isp:
-        msg = "IP: {}, провайдер: {}".format(blockcheck.mask_ip(ip_isp[0]), ip_isp[1])
-    return json.dumps({'msg': msg})
+    asn = ip_isp and blockcheck.get_ispinfo(ip_isp[0])
+    # Failed lookups are not cached
+    return ([asn], EGRESS_ASN_TTL) if asn else ([], None)
 
 
-@app.route('/dns', methods=['GET'])
-def dns():
-    global dnsv4
-    dnsv4 = blockcheck.test_dns(blockcheck.DNS_IPV4)
-    global dnsv6
-    dnsv6 = 0
-    if blockcheck.ipv6_available:
-        dnsv6 = blockcheck.test_dns(blockcheck.DNS_IPV6)
+def result_cache_key(run):
+    """
+    Return the ResultCache key of the vantage point of `run`, or None if
+    the ASN of the outgoing address of the server is unknown.
+    """
+    asn = egress_asn_cache.get(('egress',), _fetch_egress_asn)
+    if not asn:
+        return None
+    asn = asn[0]
+    resolver = tuple(run.resolver or blockcheck.dns.resolver.get_default_resolver().nameservers)
+    return (asn, resolver, 'ipv6' if run.ipv6_available else 'ipv4')
+
+
+class Job():
+    """A check running in background with its own blockcheck run context."""
+
+    def __init__(self, stages, use_cache=True):
+        self.id = uuid.uuid4().hex
+        self.run = blockcheck.RunContext(name=self.id, stages=stages, quiet=True)
+        self.use_cache = use_cache
+        self.cached_stages = []
+        self.status = 'queued'
+        self.finished = None
+
+    def execute(self):
+        self.status = 'running'
+        try:
+            vantage, key, cached = {}, None, {}
+            try:
+                with blockcheck.use_run(self.run):
+                    if not blockcheck.disable_ipv6:
+                        self.run.ipv6_available = vantage['ipv6'] = blockcheck.check_ipv6_availability()
+                    key = result_cache_key(self.run)
+            except Exception as e:
+                blockcheck.print_debug("Can't get result cache key:", repr(e))
+            if key is None:
+                result_cache.count('uncacheable')
+            elif not self.use_cache:
+                result_cache.count('bypassed')
+            else:
+                cached = result_cache.get(key, self.run.stages)
+                self.cached_stages = sorted(cached)
+
+            blockcheck.run_vantage(vantage, self.run, cached)
+            if key is not None and not self.run.results.error and not self.run.really_bad_fuckup:
+                result_cache.put(key, self.run.stage_results)
+        finally:
+            self.status = 'error' if self.run.results.error else 'done'
+            self.finished = time.monotonic()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'cached_stages': self.cached_stages,
+            'output': self.run.printed_text.getvalue(),
+            'results': self.run.results.to_dict() if self.finished else None,
+        }
+
+
+def evict_jobs():
+    now = time.monotonic()
+    with jobs_lock:
+        for job_id in [job_id for job_id, job in jobs.items() if job.finished and now - job.finished > JOB_TTL]:
+            del jobs[job_id]
+
+
+def start_job(stages, use_cache=True):
+    evict_jobs()
+    job = Job(stages, use_cache)
+    with jobs_lock:
+        jobs[job.id] = job
+    executor.submit(contextvars.Context().run, job.execute)
+    return job
+
+
+class Session():
+    """Stage results and output of one visitor of the step-by-step check."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.run = blockcheck.RunContext(name=self.id, quiet=True)
+        self.dnsv4 = 0
+        self.dnsv6 = 0
+        self.http_v4 = 0
+        self.http_v6 = 0
+        self.https = 0
+        self.last_used = time.monotonic()
+
+
+def evict_sessions():
+    now = time.monotonic()
+    with sessions_lock:
+        for session_id in [session_id for session_id, session in sessions.items()
+                           if now - session.last_used > SESSION_TTL]:
+            del sessions[session_id]
+
+
+def get_session():
+    """Return the Session of the visitor, creating a new one if needed."""
+    evict_sessions()
+    with sessions_lock:
+        session = sessions.get(request.cookies.get(SESSION_COOKIE, ''))
+        if not session:
+            session = Session()
+            sessions[session.id] = session
+            g.new_session = session.id
+        session.last_used = time.monotonic()
+    return session
+
+
+def with_session(route):
+    """Run `route` with g.session set and its blockcheck run being the current one."""
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        g.session = get_session()
+        with blockcheck.use_run(g.session.run):
+            return route(*args, **kwargs)
+    return wrapper
+
+
+@app.after_request
+def set_session_cookie(response):
+    if g.get('new_session'):
+        response.set_cookie(SESSION_COOKIE, g.new_session, max_age=SESSION_TTL, httponly=True, samesite='Lax')
+    return response
+
+
+def dns_message(dnsv4, dnsv6, ipv6_available):
     result_msg = ""
     if dnsv4 == 5:
         result_msg = "[⚠] Не удалось определить способ блокировки IPv4 DNS Если вы используете DNS провайдера, возможно, ответы DNS модифицирует вышестоящий провайдер.\nВам следует использовать шифрованный канал до DNS-серверов, например, через VPN, Tor, HTTPS/Socks прокси или DNSCrypt."
@@ -69,7 +253,7 @@ def dns():
     elif dnsv4 == 0:
         result_msg = "[✓] DNS-записи не подменяются \n[✓] DNS не перенаправляется"
 
-    if blockcheck.ipv6_available:
+    if ipv6_available:
         if dnsv6 == 5:
             result_msg += "[⚠] Не удалось определить способ блокировки IPv6 DNS.\n" + \
                           "Верните настройки DNS провайдера, если вы используете сторонний DNS-сервер." + \
@@ -94,13 +278,10 @@ def dns():
                           "Если вы хотите использовать сторонний DNS, вам следует использовать шифрованный канал до " + \
                           "DNS-серверов, например, через VPN, Tor, HTTPS/Socks прокси или DNSCrypt, но обходу " + \
                           "блокировок это не поможет."
-    return json.dumps({'msg': result_msg})
+    return result_msg
 
 
-@app.route('/https', methods=['GET'])
-def https_check():
-    global https
-    https = blockcheck.test_https_cert()
+def https_message(https):
     result_msg = ""
 
     if https == 1:
@@ -112,14 +293,10 @@ def https_check():
     elif https == 0:
         result_msg = "[✓] Доступ по HTTPS не блокируется."
 
-    return json.dumps({'msg': result_msg})
+    return result_msg
 
 
-@app.route('/http', methods=['GET'])
-def http_check():
-    global http_v4
-    global http_v6
-    http_v4, http_v6, http_isup, subdomain_blocked = blockcheck.test_http_access((dnsv4 != 0) or (dnsv6 != 0))
+def http_messages(http_v4, http_v6, http_isup, subdomain_blocked, https, ipv6_available):
     subdomain_msg = "[✓] Ваш провайдер не блокирует поддомены у заблокированного домена."
     if subdomain_blocked:
         subdomain_msg = "[⚠] Ваш провайдер блокирует поддомены у заблокированного домена."
@@ -138,7 +315,7 @@ def http_check():
                         "Убедитесь, что вы используете последнюю версию программы, и " \
                         "повторите тест позже.".format(blockcheck.isup_server)
     elif http_isup != blockcheck.HTTP_ISUP_ALLUP:
-        http_isup_msg = "[⚠] ВНУТРЕННЯЯ ОШИБКА ПРОГРАММЫ, http_isup = {}".format(blockcheck.http_isup)
+        http_isup_msg = "[⚠] ВНУТРЕННЯЯ ОШИБКА ПРОГРАММЫ, http_isup = {}".format(http_isup)
 
     def get_http_result(symbol, message):
         if http_isup == blockcheck.HTTP_ISUP_ALLUP:
@@ -149,55 +326,209 @@ def http_check():
 
     http_result = ""
     if http_v4 == blockcheck.HTTP_ACCESS_IPBLOCK:
-        if (blockcheck.ipv6_available and http_v6 == blockcheck.HTTP_ACCESS_IPBLOCK) or not blockcheck.ipv6_available:
+        if (ipv6_available and http_v6 == blockcheck.HTTP_ACCESS_IPBLOCK) or not ipv6_available:
             http_result = get_http_result("[⚠]", "Ваш провайдер блокирует по IP-адресу. " \
                                                  "Используйте любой способ обхода блокировок.")
-        elif blockcheck.ipv6_available and http_v6 != blockcheck.HTTP_ACCESS_IPBLOCK:
+        elif ipv6_available and http_v6 != blockcheck.HTTP_ACCESS_IPBLOCK:
             http_result = get_http_result("[⚠]", "Ваш провайдер блокирует IPv4-сайты по IP-адресу. " \
                                      "Используйте любой способ обхода блокировок.")
     elif http_v4 == blockcheck.HTTP_ACCESS_FULLDPI:
-        if (blockcheck.ipv6_available and http_v6 == blockcheck.HTTP_ACCESS_FULLDPI) or not blockcheck.ipv6_available:
+        if (ipv6_available and http_v6 == blockcheck.HTTP_ACCESS_FULLDPI) or not ipv6_available:
             http_result = get_http_result("[⚠]", "У вашего провайдера \"полный\" DPI. Он " \
                                      "отслеживает ссылки даже внутри прокси, " \
                                      "поэтому вам следует использовать любое " \
                                      "шифрованное соединение, например, " \
                                      "VPN или Tor.")
-        elif blockcheck.ipv6_available and http_v6 != blockcheck.HTTP_ACCESS_FULLDPI:
+        elif ipv6_available and http_v6 != blockcheck.HTTP_ACCESS_FULLDPI:
             http_result = get_http_result("[⚠]", "У вашего провайдера \"полный\" DPI для IPv4. Он " \
                                      "отслеживает ссылки даже внутри прокси, " \
                                      "поэтому вам следует использовать любое " \
                                      "шифрованное соединение, например, " \
                                      "VPN или Tor.")
     elif http_v4 == blockcheck.HTTP_ACCESS_IPDPI:
-        if (blockcheck.ipv6_available and http_v6 == blockcheck.HTTP_ACCESS_IPDPI) or not blockcheck.ipv6_available:
+        if (ipv6_available and http_v6 == blockcheck.HTTP_ACCESS_IPDPI) or not ipv6_available:
             http_result = get_http_result("[⚠]", "У вашего провайдера \"обычный\" DPI. " \
                                      "Вам поможет HTTPS/Socks прокси, VPN или Tor.")
-        elif blockcheck.ipv6_available and http_v6 != blockcheck.HTTP_ACCESS_IPDPI:
+        elif ipv6_available and http_v6 != blockcheck.HTTP_ACCESS_IPDPI:
             http_result = get_http_result("[⚠]", "У вашего провайдера \"обычный\" DPI для IPv4. " \
                                      "Вам поможет HTTPS/Socks прокси, VPN или Tor.")
     elif http_isup == blockcheck.HTTP_ISUP_ALLUP and http_v4 == blockcheck.HTTP_ACCESS_NOBLOCKS \
             and https == 0:
         http_result = get_http_result("[☺]", "Ваш провайдер не блокирует сайты.")
 
-    return json.dumps({
+    return {
         'subdomain': subdomain_msg,
         'http_isup': http_isup_msg,
         'http': http_result
-    })
+    }
+
+
+def dpi_message(dpi_result):
+    if dpi_result is None:
+        return "[✓] Проверка обхода DPI не требуется."
+    if dpi_result.working:
+        return "[✓] Работающие способы обхода DPI: {}".format(', '.join(dpi_result.working))
+    return "[⚠] Работающих способов обхода DPI не найдено."
+
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+
+@app.route('/about')
+def about():
+    return render_template('about.html')
+
+
+@app.route('/start', methods=['GET'])
+@with_session
+def button_clicked():
+    print("BUTTON CLICK!")
+    blockcheck.main()
+    msg = "Для получения корректных результатов используйте DNS-сервер провайдера и отключите средства обхода блокировок."
+    return json.dumps({'msg': msg})
+
+
+@app.route('/get-ip', methods=['GET'])
+@with_session
+def get_ip_and_isp():
+    ip_isp = blockcheck.get_ip_and_isp()
+    msg = ''
+    if ip_isp:
+        msg = "IP: {}, провайдер: {}".format(blockcheck.mask_ip(ip_isp[0]), ip_isp[1])
+    return json.dumps({'msg': msg})
+
+
+@app.route('/dns', methods=['GET'])
+@with_session
+def dns_check():
+    dnsv4 = g.session.dnsv4 = blockcheck.test_dns(blockcheck.DNS_IPV4)
+    dnsv6 = g.session.dnsv6 = 0
+    if blockcheck.ipv6_available:
+        dnsv6 = g.session.dnsv6 = blockcheck.test_dns(blockcheck.DNS_IPV6)
+    return json.dumps({'msg': dns_message(dnsv4, dnsv6, blockcheck.ipv6_available)})
+
+
+@app.route('/https', methods=['GET'])
+@with_session
+def https_check():
+    https = g.session.https = blockcheck.test_https_cert()
+    return json.dumps({'msg': https_message(https)})
+
+
+@app.route('/http', methods=['GET'])
+@with_session
+def http_check():
+    session = g.session
+    http_v4, http_v6, http_isup, subdomain_blocked = blockcheck.test_http_access(
+        (session.dnsv4 != 0) or (session.dnsv6 != 0))
+    session.http_v4, session.http_v6 = http_v4, http_v6
+    return json.dumps(http_messages(http_v4, http_v6, http_isup, subdomain_blocked, session.https,
+                                    blockcheck.ipv6_available))
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    params = request.get_json(silent=True) or {}
+    stages = params.get('stages') or request.form.getlist('stages') or blockcheck.STAGES
+    if not set(stages) <= set(blockcheck.STAGES):
+        return json.dumps({'error': 'unknown stage'}), 400
+    nocache = params.get('nocache') or request.values.get('nocache') in ('1', 'true')
+    job = start_job(tuple(stages), use_cache=not nocache)
+    return json.dumps({'id': job.id, 'status': job.status}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if not job:
+        return json.dumps({'error': 'no such job'}), 404
+    return json.dumps(job.to_dict())
+
+
+def sse(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+def job_events(job):
+    """
+    Turn the progress of the job into server-sent events for the page:
+    'line' with printed text, 'dns', 'https', 'http' and 'dpi' with the
+    same messages as the step-by-step routes and 'done' at the end.
+    """
+    listener = job.run.subscribe()
+    http_pending = False
+    try:
+        while True:
+            try:
+                event, data = listener.get(timeout=KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event == 'line':
+                yield sse('line', {'text': data})
+            elif event == 'stage':
+                stage, results = data['stage'], data['results']
+                if stage == 'dns':
+                    yield sse('dns', {'msg': dns_message(results['dns_v4'], results['dns_v6'],
+                                                         job.run.ipv6_available)})
+                elif stage == 'https':
+                    yield sse('https', {'msg': https_message(results['https'])})
+                elif stage == 'dpi':
+                    yield sse('dpi', {'msg': dpi_message(job.run.results.dpi)})
+                # The message of HTTP stage depends on the verdict of HTTPS one
+                http_pending = http_pending or stage == 'http'
+                if http_pending and (results['https'] is not None or 'https' not in job.run.stages):
+                    http_pending = False
+                    yield sse('http', http_messages(results['http_v4'], results['http_v6'], results['http_isup'],
+                                                    results['subdomain_blocked'], results['https'],
+                                                    job.run.ipv6_available))
+            elif event == 'done':
+                yield sse('done', {'error': job.run.results.error})
+                return
+    finally:
+        job.run.unsubscribe(listener)
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if not job:
+        return json.dumps({'error': 'no such job'}), 404
+    return Response(stream_with_context(job_events(job)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/cache', methods=['GET'])
+def get_cache():
+    return json.dumps(result_cache.to_dict())
+
+
+@app.route('/cache', methods=['DELETE'])
+def invalidate_cache():
+    # Only the administrator of the server may drop the cache. Requests come
+    # through a reverse proxy, so their address tells nothing about the sender.
+    token = request.headers.get('Authorization', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ('Bearer ' + ADMIN_TOKEN).encode()):
+        return json.dumps({'error': 'forbidden'}), 403
+    return json.dumps({'dropped': result_cache.invalidate(request.args.get('asn'))})
 
 
 @app.route('/dpi', methods=['GET'])
+@with_session
 def dpi_check():
-    if http_v4 > 0 or http_v6 > 0 or blockcheck.force_dpi_check:
+    if g.session.http_v4 > 0 or g.session.http_v6 > 0 or blockcheck.force_dpi_check:
         dpi = blockcheck.test_dpi()
-        print(dpi)
         return json.dumps({'msg': dpi})
+    return json.dumps({'msg': ''})
 
 
 def run_app():
-    app.debug = True
     app.config['JSON_AS_ASCII'] = False
-    app.run()
+    app.run(threaded=True)
 
 
 if __name__ == "__main__":